@@ -1,83 +1,49 @@
 import ast
 import os
-import time
 import openai
+from ai_request.llm import chat_completion
 from utils import logger, parse_srt
-from ai_request.utils import group_chunks, num_tokens_from_messages
+from ai_request.utils import count_tokens, group_chunks, prompt_overhead
+
+FIX_PROMPT = "You will be provided with a subtitle content, and your task is to combine two subtitle items if the item sentence is not complete.  Then correct any spelling discrepancies in the content. Then if the slash word is inside a url, convert it to /."
 
 
 def fix(text):
     openai.api_key = os.getenv("OPENAI_API_KEY")
-    prompt_text="You will be provided with a subtitle content, and your task is to combine two subtitle items if the item sentence is not complete.  Then correct any spelling discrepancies in the content. Then if the slash word is inside a url, convert it to /."
+    prompt_text = FIX_PROMPT
+    t_text = chat_completion(
+        [
+            {
+                "role": "system",
+                "content": prompt_text,
+            },
+            {
+                "role": "user",
+                "content": text
+            }
+        ],
+        model="gpt-3.5-turbo-16k",
+        temperature=0,
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0
+    )
+    logger.info(t_text)
     try:
-        completion = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo-16k",
-            messages=[
-                {
-                    "role": "system",
-                    "content": prompt_text,
-                },
-                {
-                    "role": "user",
-                    "content": text
-                }
-            ],
-            temperature=0,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0
-        )
-        t_text = (
-            completion["choices"][0]  # type: ignore
-            .get("message")
-            .get("content")
-            .encode("utf8")
-            .decode()
-        )
-        logger.info(t_text)
-
-        try:
-            t_text = ast.literal_eval(t_text)
-        except Exception:
-            pass
-        time.sleep(3)
-    except Exception as e:
-        print(str(e), "will sleep 60 seconds")
-        # TIME LIMIT for open api please pay
-        time.sleep(60)
-        completion = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo-16k",
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt_text
-                }
-            ],
-        )
-        t_text = (
-            completion["choices"][0]  # type: ignore
-            .get("message")
-            .get("content")
-            .encode("utf8")
-            .decode()
-        )
-        t_text = t_text.strip("\n")
-        try:
-            t_text = ast.literal_eval(t_text)
-        except Exception:
-            pass
+        t_text = ast.literal_eval(t_text)
+    except Exception:
+        # some ["\n"] not literal_eval, not influence the result
+        pass
     return t_text
 
 
 def fix_subtitle(subtitles):
-    ntokens = []
-    chunks = []
-    for subtitle in subtitles:
-        logger.info(subtitle)
-        chunk = str(subtitle["id"]) + '\n' + subtitle["time"] + '\n' + subtitle["text"]
-        chunks.append(chunk)
-        ntokens.append(num_tokens_from_messages(chunk))
-    chunks = group_chunks(chunks, ntokens)
+    chunks = [
+        str(subtitle["id"]) + '\n' + subtitle["time"] + '\n' + subtitle["text"]
+        for subtitle in subtitles
+    ]
+    chunks = group_chunks(chunks, count_tokens(chunks),
+                          overhead=prompt_overhead(FIX_PROMPT))
     fixed_chunks = []
     for chunk in chunks:
         logger.info(chunk)
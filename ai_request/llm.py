@@ -0,0 +1,126 @@
+"""
+Chat completions shared by translation, summary, recos and fixing: every
+call takes from cluster wide request and token budgets per model, and
+failed calls are retried with the same request.
+"""
+import os
+import random
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+import openai
+from ai_request.rate_limit import TokenBucket
+from ai_request.utils import num_tokens_from_chat
+from utils import logger
+
+# Budgets per model, 0 disables a limit
+LLM_REQUESTS_PER_MINUTE = int(os.environ.get('LLM_REQUESTS_PER_MINUTE', 3500))
+LLM_TOKENS_PER_MINUTE = int(os.environ.get('LLM_TOKENS_PER_MINUTE', 180000))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 6))
+# Backoff doubles from LLM_BACKOFF_BASE up to LLM_BACKOFF_MAX seconds
+LLM_BACKOFF_BASE = float(os.environ.get('LLM_BACKOFF_BASE', 1))
+LLM_BACKOFF_MAX = float(os.environ.get('LLM_BACKOFF_MAX', 60))
+
+RETRY_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+)
+RESET_PATTERN = re.compile(r'([\d.]+)(ms|h|m|s)')
+RESET_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+buckets: Dict[str, Tuple[TokenBucket, TokenBucket]] = {}
+buckets_lock = threading.Lock()
+
+
+def model_buckets(model: str) -> Tuple[TokenBucket, TokenBucket]:
+    with buckets_lock:
+        if model not in buckets:
+            buckets[model] = (
+                TokenBucket(f'llm:{model}:requests', LLM_REQUESTS_PER_MINUTE),
+                TokenBucket(f'llm:{model}:tokens', LLM_TOKENS_PER_MINUTE),
+            )
+        return buckets[model]
+
+
+def parse_reset(value: str) -> Optional[float]:
+    """
+    Seconds from a rate limit reset header, either plain seconds or a
+    duration like 6m0s or 20ms.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = RESET_PATTERN.findall(value)
+    if len(parts) == 0:
+        return None
+    return sum(float(amount) * RESET_UNITS[unit] for amount, unit in parts)
+
+
+def retry_after(ex: Exception) -> Optional[float]:
+    """
+    Seconds the API asked us to wait before trying again, if it said so.
+    Reset headers give the time until a whole window refills, so they are
+    only used for a budget that has nothing remaining.
+    """
+    headers = getattr(ex, 'headers', None) or {}
+    if headers.get('retry-after-ms'):
+        return float(headers['retry-after-ms']) / 1000
+    if headers.get('retry-after'):
+        return parse_reset(headers['retry-after'])
+    waits = [parse_reset(headers[f'x-ratelimit-reset-{budget}']) for budget in ('requests', 'tokens')
+             if headers.get(f'x-ratelimit-remaining-{budget}') == '0' and headers.get(f'x-ratelimit-reset-{budget}')]
+    waits = [wait for wait in waits if wait is not None]
+    return max(waits) if len(waits) > 0 else None
+
+
+def backoff(attempt: int) -> float:
+    """
+    Exponential backoff with full jitter, so workers that failed together
+    do not retry together.
+    """
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+
+
+def chat_completion(messages: List[dict], model: str = "gpt-3.5-turbo-16k", **params) -> str:
+    """
+    Content of the first choice. Rate limited and server errors are retried
+    with the same messages, after the wait the API asks for or a jittered
+    backoff. Other errors are raised right away.
+    """
+    requests, tokens = model_buckets(model)
+    prompt_tokens = num_tokens_from_chat(messages, model)
+    # The completion is charged once its actual size is known
+    estimate = prompt_tokens + params.get('max_tokens', 0)
+    attempt = 0
+    while True:
+        requests.acquire()
+        tokens.acquire(estimate)
+        try:
+            completion = openai.ChatCompletion.create(
+                model=model, messages=messages, **params)
+            break
+        except RETRY_ERRORS as ex:
+            if attempt == LLM_MAX_RETRIES:
+                raise
+            wait = retry_after(ex)
+            wait = backoff(attempt) if wait is None else wait + random.uniform(0, 1)
+            logger.warning(
+                f'{model} {type(ex).__name__}, retrying in {wait:.1f}s')
+            time.sleep(wait)
+            attempt += 1
+    usage = completion.get('usage') or {}  # type: ignore
+    if usage.get('total_tokens', 0) > estimate:
+        tokens.acquire(usage['total_tokens'] - estimate)
+    return (
+        completion["choices"][0]  # type: ignore
+        .get("message")
+        .get("content")
+        .encode("utf8")
+        .decode()
+    )
@@ -0,0 +1,85 @@
+import os
+import time
+import uuid
+from contextlib import contextmanager
+import redis
+
+redis_client = redis.Redis.from_url(
+    os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379"))
+
+# Refill the bucket for the time passed since the last call, then take the
+# requested tokens or report how many seconds until they are available.
+# Time comes from redis so every worker shares one clock.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + (now - updated) * rate)
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+token_bucket_script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+
+
+class TokenBucket:
+    """
+    Token bucket shared by all workers through redis, holding up to capacity
+    tokens and refilling them evenly over period seconds. A capacity of 0
+    disables the limit.
+    """
+
+    def __init__(self, name: str, capacity: float, period: float = 60):
+        self.key = f'rate_limit:{name}'
+        self.capacity = capacity
+        self.rate = capacity / period if period > 0 else 0
+
+    def acquire(self, amount: float = 1):
+        """
+        Block until amount tokens are taken from the bucket.
+        """
+        if self.capacity <= 0:
+            return
+        amount = min(amount, self.capacity)
+        while True:
+            wait = float(token_bucket_script(
+                keys=[self.key], args=[self.capacity, self.rate, amount]))
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+class InFlight:
+    """
+    Count of calls in progress across all workers, kept as a redis sorted
+    set of start times. Entries older than ttl seconds are dropped, so a
+    worker that dies mid call does not hold a slot forever.
+    """
+
+    def __init__(self, name: str, ttl: float = 15 * 60):
+        self.key = f'in_flight:{name}'
+        self.ttl = ttl
+
+    @contextmanager
+    def hold(self):
+        token = uuid.uuid4().hex
+        redis_client.zadd(self.key, {token: time.time()})
+        try:
+            yield
+        finally:
+            redis_client.zrem(self.key, token)
+
+    def count(self) -> int:
+        redis_client.zremrangebyscore(self.key, '-inf', time.time() - self.ttl)
+        return redis_client.zcard(self.key)
@@ -2,82 +2,45 @@
 Code from https://github.com/rongjc/autosubtitle/blob/main/translate.py
 """
 import ast
-import time
-import openai
+from ai_request.llm import chat_completion
 from utils import logger
-from ai_request.utils import group_chunks, num_tokens_from_messages
+from ai_request.utils import count_tokens, group_chunks, num_tokens_from_chat
 
-def get_recos(text):
-
-    prompt_text = f"""
+RECOS_MODEL = "gpt-4"
+RECOS_PROMPT = """
 I want you to extract info from text if any movies books you found.Return the item list split with |,return result with json object, Text:
 {text}"""
+
+
+def get_recos(text):
+
+    prompt_text = RECOS_PROMPT.format(text=text)
     print(prompt_text)
+    t_text = chat_completion(
+        [
+            {
+                "role": "user",
+                "content": prompt_text
+            }
+        ],
+        model=RECOS_MODEL
+    )
     try:
-        completion = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt_text
-                }
-            ],
-        )
-        t_text = (
-            completion["choices"][0]  # type: ignore
-            .get("message")
-            .get("content")
-            .encode("utf8")
-            .decode()
-        )
-        # format the translated text, the original text is eg: "\n\n['\\n柠檬\\n\\n', '梶井基次郎']", we need the
-        # element in the list, not the \n \n
-
-        try:
-            t_text = ast.literal_eval(t_text)
-        except Exception:
-            # some ["\n"] not literal_eval, not influence the result
-            pass
-        # openai has a time limit for api  Limit: 20 / min
-        time.sleep(3)
-    except Exception as e:
-        logger.info(str(e), "will sleep 60 seconds")
-        # TIME LIMIT for open api please pay
-        time.sleep(60)
-        completion = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt_text
-                }
-            ],
-        )
-        t_text = (
-            completion["choices"][0]  # type: ignore
-            .get("message")
-            .get("content")
-            .encode("utf8")
-            .decode()
-        )
-        t_text = t_text.strip("\n")
-        try:
-            t_text = ast.literal_eval(t_text)
-        except Exception:
-            pass
+        t_text = ast.literal_eval(t_text)
+    except Exception:
+        # some ["\n"] not literal_eval, not influence the result
+        pass
     logger.info(t_text)
     return t_text
 
 
 def subtitle_recos(subtitles):
-    ntokens = []
-    chunks = []
-    for subtitle in subtitles:
-        chunk = subtitle['text']
-        chunks.append(chunk)
-        ntokens.append(num_tokens_from_messages(chunk))
-
-    chunks = group_chunks(chunks, ntokens)
+    chunks = [subtitle['text'] for subtitle in subtitles]
+    # The text goes inside the prompt of a single user message
+    overhead = num_tokens_from_chat(
+        [{"content": RECOS_PROMPT.format(text="")}], RECOS_MODEL)
+    chunks = group_chunks(chunks, count_tokens(chunks, RECOS_MODEL),
+                          overhead=overhead, model=RECOS_MODEL)
     recos_chunks = {
         "books": [],
         "movies": [],
@@ -3,76 +3,42 @@ forked from https://github.com/rongjc/autosubtitle/blob/main/translate.py
 """
 import ast
 import os
-import time
 import openai
+from ai_request.llm import chat_completion
 from utils import logger
-from ai_request.utils import group_chunks, num_tokens_from_messages, supportedLanguages
+from ai_request.utils import count_tokens, group_chunks, prompt_overhead, supportedLanguages
 
 
-def summary(text, output_locale):
+def summary_prompt(output_locale):
     output_language = supportedLanguages[output_locale]
-    prompt_text = f"You will be provided with podcast transcription, and your task is to summarize the podcast into a {output_language} text in about 50 words"
+    return f"You will be provided with podcast transcription, and your task is to summarize the podcast into a {output_language} text in about 50 words"
+
+
+def summary(text, output_locale):
+    prompt_text = summary_prompt(output_locale)
     print(prompt_text)
+    t_text = chat_completion(
+        [
+            {
+                "role": "system",
+                "content": prompt_text,
+            },
+            {
+                "role": "user",
+                "content": text
+            }
+        ],
+        model="gpt-3.5-turbo-16k",
+        temperature=0,
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0
+    )
     try:
-        completion = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo-16k",
-            messages=[
-                {
-                    "role": "system",
-                    "content": prompt_text,
-                },
-                {
-                    "role": "user",
-                    "content": text
-                }
-            ],
-            temperature=0,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0
-        )
-        t_text = (
-            completion["choices"][0]  # type: ignore
-            .get("message")
-            .get("content")
-            .encode("utf8")
-            .decode()
-        )
-        # format the translated text, the original text is eg: "\n\n['\\n柠檬\\n\\n', '梶井基次郎']", we need the
-        # element in the list, not the \n \n
-
-        try:
-            t_text = ast.literal_eval(t_text)
-        except Exception:
-            # some ["\n"] not literal_eval, not influence the result
-            pass
-        # openai has a time limit for api  Limit: 20 / min
-        time.sleep(3)
-    except Exception as e:
-        print(str(e), "will sleep 60 seconds")
-        # TIME LIMIT for open api please pay
-        time.sleep(60)
-        completion = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo-16k",
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt_text
-                }
-            ],
-        )
-        t_text = (
-            completion["choices"][0]  # type: ignore
-            .get("message")
-            .get("content")
-            .encode("utf8")
-            .decode()
-        )
-        t_text = t_text.strip("\n")
-        try:
-            t_text = ast.literal_eval(t_text)
-        except Exception:
-            pass
+        t_text = ast.literal_eval(t_text)
+    except Exception:
+        # some ["\n"] not literal_eval, not influence the result
+        pass
     logger.info(t_text)
     return t_text
 
@@ -80,14 +46,9 @@ def summary(text, output_locale):
 def subtitle_summary(subtitles, output_language):
 
     openai.api_key = os.getenv("OPENAI_API_KEY")
-    ntokens = []
-    chunks = []
-    for subtitle in subtitles:
-        chunk = subtitle['text']
-        chunks.append(chunk)
-        ntokens.append(num_tokens_from_messages(chunk))
-
-    chunks = group_chunks(chunks, ntokens)
+    chunks = [subtitle['text'] for subtitle in subtitles]
+    chunks = group_chunks(chunks, count_tokens(chunks),
+                          overhead=prompt_overhead(summary_prompt(output_language)))
     summary_chunks = []
     for i, chunk in enumerate(chunks):
         print(str(i+1) + " / " + str(len(chunks)))
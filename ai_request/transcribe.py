@@ -0,0 +1,116 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+import openai
+from ai_request.rate_limit import InFlight, TokenBucket
+from audio.segment import AudioSlice
+from utils import Cue, join_cues, logger, segments_to_cues
+
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "_")
+# openai for the whisper API, local for faster-whisper on this worker
+TRANSCRIBE_BACKEND = os.environ.get('TRANSCRIBE_BACKEND', 'openai')
+WHISPER_MODEL_SIZE = os.environ.get('WHISPER_MODEL_SIZE', 'medium')
+WHISPER_DEVICE = os.environ.get('WHISPER_DEVICE', 'cpu')
+WHISPER_COMPUTE_TYPE = os.environ.get('WHISPER_COMPUTE_TYPE', 'int8')
+# 0 lets ctranslate2 pick
+WHISPER_CPU_THREADS = int(os.environ.get('WHISPER_CPU_THREADS', 0))
+WHISPER_DOWNLOAD_ROOT = os.environ.get('WHISPER_DOWNLOAD_ROOT', '/data')
+# Keep per word timings on each subtitle
+TRANSCRIBE_WORD_TIMESTAMPS = os.environ.get(
+    'TRANSCRIBE_WORD_TIMESTAMPS', 'false').lower() == 'true'
+# Transcriptions in flight per worker process
+TRANSCRIBE_CONCURRENCY = int(os.environ.get('TRANSCRIBE_CONCURRENCY', 8))
+# Cluster wide quota, 0 disables a limit
+WHISPER_REQUESTS_PER_MINUTE = int(
+    os.environ.get('WHISPER_REQUESTS_PER_MINUTE', 50))
+WHISPER_AUDIO_MINUTES_PER_MINUTE = int(
+    os.environ.get('WHISPER_AUDIO_MINUTES_PER_MINUTE', 0))
+# Slices the whole cluster can transcribe at once
+TRANSCRIBE_CAPACITY = int(os.environ.get('TRANSCRIBE_CAPACITY', 16))
+# Longest a slice task may run, in seconds. Slices stay counted in flight
+# for as long, so a slow slice is not taken for free capacity
+TRANSCRIBE_TIME_LIMIT = 20 * 60
+
+transcribe_executor = ThreadPoolExecutor(max_workers=TRANSCRIBE_CONCURRENCY)
+request_bucket = TokenBucket('whisper:requests', WHISPER_REQUESTS_PER_MINUTE)
+audio_bucket = TokenBucket('whisper:audio_seconds',
+                           WHISPER_AUDIO_MINUTES_PER_MINUTE * 60)
+in_flight = InFlight('transcribe', ttl=TRANSCRIBE_TIME_LIMIT)
+
+
+local_model = None
+local_model_lock = threading.Lock()
+
+
+def get_local_model():
+    """
+    The faster-whisper model, loaded once per worker process and shared by
+    every task after that.
+    """
+    global local_model
+    with local_model_lock:
+        if local_model is None:
+            from faster_whisper import WhisperModel
+            logger.info(f'loading whisper model {WHISPER_MODEL_SIZE}')
+            local_model = WhisperModel(WHISPER_MODEL_SIZE, device=WHISPER_DEVICE,
+                                       compute_type=WHISPER_COMPUTE_TYPE, cpu_threads=WHISPER_CPU_THREADS,
+                                       num_workers=TRANSCRIBE_CONCURRENCY, download_root=WHISPER_DOWNLOAD_ROOT)
+        return local_model
+
+
+def local_transcribe(audio: AudioSlice, prompt: str, model=None) -> List[Cue]:
+    model = model or get_local_model()
+    segments, _ = model.transcribe(
+        audio.path, beam_size=5, initial_prompt=prompt or None,
+        word_timestamps=TRANSCRIBE_WORD_TIMESTAMPS)
+    return segments_to_cues(list(segments))
+
+
+def openai_transcribe(audio: AudioSlice, prompt: str) -> List[Cue]:
+    request_bucket.acquire()
+    audio_bucket.acquire((audio.end - audio.start) / 1000)
+    params = {}
+    if TRANSCRIBE_WORD_TIMESTAMPS:
+        # Array fields only arrive as multipart fields named with []
+        params['timestamp_granularities[]'] = ['segment', 'word']
+    with open(audio.path, "rb") as f:
+        transcript = openai.Audio.transcribe(
+            "whisper-1", f, api_key=OPENAI_API_KEY, response_format='verbose_json',
+            prompt=prompt, **params)
+    words = transcript.get('words') if TRANSCRIBE_WORD_TIMESTAMPS else None  # type: ignore
+    return segments_to_cues(transcript.get('segments') or [], words)  # type: ignore
+
+
+def free_concurrency() -> int:
+    """
+    Transcription slots not taken by any worker right now, at least 1.
+    """
+    return max(1, TRANSCRIBE_CAPACITY - in_flight.count())
+
+
+def transcribe_audio(audio: AudioSlice, format: str, prompt: str) -> List[Cue]:
+    """
+    Subtitles of one slice, timed from the start of the slice. Both backends
+    return whisper's segments, plain text results are joined into a single
+    subtitle spanning the slice.
+    """
+    logger.info(f'transcribing {audio.path} with {TRANSCRIBE_BACKEND}')
+    with in_flight.hold():
+        if TRANSCRIBE_BACKEND == 'local':
+            cues = local_transcribe(audio, prompt)
+        else:
+            cues = openai_transcribe(audio, prompt)
+    # Failed slices are kept for a retry
+    os.remove(audio.path)
+    if format == 'text':
+        return join_cues(cues, 0, audio.end - audio.start)
+    return cues
+
+
+def transcribe_slices(sliced_audios: List[AudioSlice], format: str, prompt: str) -> List[List[Cue]]:
+    """
+    Transcribe slices on the shared executor, results keep the slice order.
+    """
+    return list(transcribe_executor.map(
+        lambda audio: transcribe_audio(audio, format, prompt), sliced_audios))
@@ -1,108 +1,171 @@
 """
 forked from https://github.com/rongjc/autosubtitle/blob/main/translate.py
 """
-import ast
+import hashlib
+import json
 import os
-import time
 import openai
-import re
-from utils import logger
-from ai_request.utils import group_chunks, num_tokens_from_messages, supportedLanguages
+from concurrent.futures import ThreadPoolExecutor
+from ai_request.llm import chat_completion
+from ai_request.rate_limit import redis_client
+from utils import logger, pack_batches
+from ai_request.utils import count_tokens, prompt_overhead, supportedLanguages
 
+# Batches of one transcript translated side by side
+TRANSLATE_CONCURRENCY = int(os.environ.get('TRANSLATE_CONCURRENCY', 4))
 
-def translate(text, output_locale):
+TRANSLATE_MODEL = "gpt-3.5-turbo-16k"
+# Bump when the prompt changes so cached translations are not reused
+TRANSLATE_PROMPT_VERSION = 2
+# Requests per batch, the first one and re-requests of missing ids
+TRANSLATE_ATTEMPTS = int(os.environ.get('TRANSLATE_ATTEMPTS', 3))
+# Cached translations expire after this many seconds without being used
+TRANSLATION_CACHE_TTL = int(
+    os.environ.get('TRANSLATION_CACHE_TTL', 30 * 24 * 60 * 60))
+
+translate_executor = ThreadPoolExecutor(max_workers=TRANSLATE_CONCURRENCY)
+
+
+def translation_key(text, output_locale):
+    digest = hashlib.sha256(text.encode()).hexdigest()
+    return f'translation:{TRANSLATE_MODEL}:{TRANSLATE_PROMPT_VERSION}:{output_locale}:{digest}'
+
+
+def get_cached_translations(texts, output_locale):
+    """
+    Cached translation of each text or None, a hit keeps the entry for
+    another TRANSLATION_CACHE_TTL.
+    """
+    pipeline = redis_client.pipeline(transaction=False)
+    for text in texts:
+        pipeline.getex(translation_key(text, output_locale),
+                       ex=TRANSLATION_CACHE_TTL)
+    return [None if value is None else value.decode() for value in pipeline.execute()]
+
+
+def save_translations(translations, output_locale):
+    """
+    Cache (text, translation) pairs.
+    """
+    pipeline = redis_client.pipeline(transaction=False)
+    for text, translation in translations:
+        pipeline.set(translation_key(text, output_locale),
+                     translation, ex=TRANSLATION_CACHE_TTL)
+    pipeline.execute()
+
+
+def translate_prompt(output_locale):
     output_language = supportedLanguages[output_locale]
-    prompt_text = f"You will be provided with a subtitle content,  and your task is to convert them to standard {output_language}."
+    return (f"You will be provided with a JSON object mapping subtitle ids to subtitle text, and your task is to convert each text to standard {output_language}. "
+            "Reply with only a JSON object with the same ids as keys and the converted texts as values. Keep every id, do not merge or split subtitles.")
+
 
+def parse_translations(reply, ids):
+    """
+    Translations by id from a JSON reply, keeping only ids that were asked
+    for and have a non empty text.
+    """
+    reply = reply.strip()
+    if reply.startswith("```"):
+        reply = reply.strip("`").removeprefix("json").strip()
     try:
-        completion = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo-16k",
-            messages=[
-                {
-                    "role": "system",
-                    "content": prompt_text,
-                },
-                {
-                    "role": "user",
-                    "content": text
-                }
-            ],
-            temperature=0,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0
-        )
-        t_text = (
-            completion["choices"][0]  # type: ignore
-            .get("message")
-            .get("content")
-            .encode("utf8")
-            .decode()
-        )
-
-        try:
-            t_text = ast.literal_eval(t_text)
-        except Exception:
-            # some ["\n"] not literal_eval, not influence the result
-            pass
-        # openai has a time limit for api  Limit: 20 / min
-        time.sleep(3)
-    except Exception as e:
-        print(str(e), "will sleep 60 seconds")
-        # TIME LIMIT for open api please pay
-        time.sleep(60)
-        completion = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo-16k",
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt_text
-                }
-            ],
-        )
-        t_text = (
-            completion["choices"][0]  # type: ignore
-            .get("message")
-            .get("content")
-            .encode("utf8")
-            .decode()
-        )
-        t_text = t_text.strip("\n")
-        try:
-            t_text = ast.literal_eval(t_text)
-        except Exception:
-            pass
-    print(t_text)
-    return t_text
+        translations = json.loads(reply)
+    except ValueError:
+        return {}
+    if not isinstance(translations, dict):
+        return {}
+    return {
+        id: text.strip() for id, text in translations.items()
+        if id in ids and isinstance(text, str) and text.strip() != ''
+    }
 
 
-def translate_gpt(subtitles, output_language):
+def translate(texts, output_locale):
+    """
+    Translate a batch of {id: text} in one request, the reply may miss ids.
+    Replies are cached by request, since a batch can come up again when a
+    transcript is translated once more.
+    """
+    request = json.dumps(texts, ensure_ascii=False)
+    cached, = get_cached_translations([request], output_locale)
+    if cached is not None:
+        return parse_translations(cached, texts)
+    reply = chat_completion(
+        [
+            {
+                "role": "system",
+                "content": translate_prompt(output_locale),
+            },
+            {
+                "role": "user",
+                "content": request
+            }
+        ],
+        model=TRANSLATE_MODEL,
+        temperature=0,
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0
+    )
+    translations = parse_translations(reply, texts)
+    if len(translations) == len(texts):
+        save_translations([(request, reply)], output_locale)
+    return translations
+
 
+def translate_batch(texts, output_locale):
+    """
+    Translate {id: text}, asking again only for the ids a reply left out or
+    garbled, up to TRANSLATE_ATTEMPTS requests.
+    """
+    translations = {}
+    pending = texts
+    for attempt in range(TRANSLATE_ATTEMPTS):
+        translations.update(translate(pending, output_locale))
+        pending = {id: text for id, text in texts.items()
+                   if id not in translations}
+        if len(pending) == 0:
+            break
+        logger.warning(
+            f'translation missed {len(pending)} of {len(texts)} subtitles, attempt {attempt + 1}')
+    return translations
+
+
+def translate_gpt(subtitles, output_language):
+    """
+    Set default_translation_text on each subtitle. Subtitles whose text was
+    translated before are taken from the cache. The rest is sent to the
+    model in batches keyed by id, so a reply that drops or merges lines
+    only costs a request for those lines and never shifts the others.
+    """
     openai.api_key = os.getenv("OPENAI_API_KEY")
-    ntokens = []
-    chunks = []
-    for subtitle in subtitles:
-        chunk = str(subtitle['start_time'] + '-->' +
-                    subtitle['end_time'] + '\n' + subtitle['text'])
-        chunks.append(chunk)
-        ntokens.append(num_tokens_from_messages(chunk))
-
-    chunks = group_chunks(chunks, ntokens)
-    translated_chunks = []
-    for i, chunk in enumerate(chunks):
-        print(str(i+1) + " / " + str(len(chunks)))
-        translated_chunks.append(translate(chunk, output_language)+"\n")
-
-    # join the chunks together
-    result = '\n'.join(translated_chunks)
-    data = []
-    pattern = r'(\d{2}:\d{2}:\d{2},\d{3}\s*-->\s*\d{2}:\d{2}:\d{2},\d{3})\n(.+?)\n'
-    matches = re.findall(pattern, result, re.DOTALL)
-    for match in matches:
-        data.append(match[1])
-
-    for index, subtitle in enumerate(subtitles):
-        if index < len(data):
-            subtitle['default_translation_text'] = data[index]
-    print(result, matches, data)
+    cached = get_cached_translations(
+        [subtitle['text'] for subtitle in subtitles], output_language)
+    missing = []
+    for subtitle, translation in zip(subtitles, cached):
+        if translation is None:
+            missing.append(subtitle)
+        else:
+            subtitle['default_translation_text'] = translation
+    if len(missing) == 0:
+        return subtitles
+    # Ids are positions in missing, unique and short
+    entries = [json.dumps({str(index): subtitle['text']}, ensure_ascii=False)[1:-1]
+               for index, subtitle in enumerate(missing)]
+    batches = pack_batches(count_tokens(entries, TRANSLATE_MODEL),
+                           overhead=prompt_overhead(
+                               translate_prompt(output_language), TRANSLATE_MODEL) + 2,
+                           separator_tokens=1)
+    # Batches are independent, map keeps their order
+    results = translate_executor.map(
+        lambda batch: translate_batch({str(index): missing[index]['text'] for index in batch}, output_language), batches)
+    translations = []
+    for translated in results:
+        for id, text in translated.items():
+            subtitle = missing[int(id)]
+            subtitle['default_translation_text'] = text
+            translations.append((subtitle['text'], text))
+    save_translations(translations, output_language)
+    logger.info(
+        f'translated {len(translations)} of {len(missing)} subtitles to {output_language}')
     return subtitles
@@ -1,40 +1,56 @@
+from functools import lru_cache
+from typing import List
 import tiktoken
+from utils import pack_batches
 
+# Chat format cost of each message and of priming the reply, for the
+# gpt-3.5-turbo and gpt-4 models
+MESSAGE_OVERHEAD = 3
+REPLY_OVERHEAD = 3
+CHUNK_SEPARATOR = "\n\n"
 
-def group_chunks(chunks, ntokens, max_len=5000):
-    """
-    Group very short chunks, to form approximately a page long chunks.
-    """
-    batches = []
-    cur_batch = ""
-    cur_tokens = 0
 
-    # iterate over chunks, and group the short ones together
-    for chunk, ntoken in zip(chunks, ntokens):
-        # print(ntoken)
-        # notken = num_tokens_from_messages(chunk)
-        cur_tokens += ntoken + 2  # +2 for the newlines between chunks
+@lru_cache(maxsize=None)
+def get_encoding(model="gpt-3.5-turbo-16k"):
+    """The tokenizer of a model, built once per process."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
 
-        # if adding this chunk would exceed the max length, finalize the current batch and start a new one
-        if ntoken + cur_tokens > max_len:
-            batches.append(cur_batch)
-            cur_batch = chunk
-            cur_tokens = 0
-        else:
-            cur_batch += "\n\n" + chunk
-            # cur_batch += chunk
-    batches.append(cur_batch)
-    return batches
+def count_tokens(texts: List[str], model="gpt-3.5-turbo-16k") -> List[int]:
+    """Number of tokens of each text, encoded in one batch."""
+    return [len(tokens) for tokens in get_encoding(model).encode_batch(texts)]
 
 
 def num_tokens_from_messages(message, model="gpt-3.5-turbo-16k"):
     """Returns the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    num_tokens = len(encoding.encode(message))
-    return num_tokens
+    return len(get_encoding(model).encode(message))
+
+
+def num_tokens_from_chat(messages, model="gpt-3.5-turbo-16k"):
+    """Prompt tokens of a chat request, including the chat format overhead."""
+    contents = count_tokens([message["content"] for message in messages], model)
+    return sum(contents) + MESSAGE_OVERHEAD * len(messages) + REPLY_OVERHEAD
+
+
+def prompt_overhead(system_prompt, model="gpt-3.5-turbo-16k"):
+    """
+    Tokens a request with this system prompt costs besides the user content.
+    """
+    return num_tokens_from_chat([{"content": system_prompt}, {"content": ""}], model)
+
+
+def group_chunks(chunks, ntokens, max_len=5000, overhead=0, model="gpt-3.5-turbo-16k"):
+    """
+    Join consecutive chunks into batches packed with pack_batches.
+    """
+    separator_tokens = num_tokens_from_messages(CHUNK_SEPARATOR, model)
+    return [
+        CHUNK_SEPARATOR.join([chunks[index] for index in batch])
+        for batch in pack_batches(ntokens, max_len, overhead, separator_tokens)
+    ]
 
 
 supportedLanguages = {
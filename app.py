@@ -1,41 +1,46 @@
+import asyncio
 import os
-import io
 import shutil
-import zipfile
-import openai
 import uuid
 import json
-import requests
 import logging
-import multiprocessing
+import time
 from jose import jwe
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
-from datetime import datetime
 from typing import Annotated
-from fastapi import Depends, FastAPI, Form, HTTPException, UploadFile
+from fastapi import Depends, FastAPI, Form, Header, HTTPException, Request, Response, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from pydub import AudioSegment
-from tqdm import tqdm
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 from database.database import add_credit_record, get_credit_record, get_user_credit, get_user_lang, update_credit_record_status, update_credit_record_task_id, update_user_credit
 from pytube import YouTube
-from utils import logger
+from utils import logger, merge_cues, render_cues
+from audio.download import MAX_DOWNLOAD_SIZE, DownloadError, download_audio, spool_file
+from audio.archive import stream_zip
+from audio.boundary import SILENCE_TOLERANCE, find_silence_boundaries
+from audio.probe import probe_audio, probe_duration
+from audio.plan import min_slice_count, plan_slice_count
+from audio.segment import iter_segments, segment_audio, slice_bit_rate
 from fastapi.staticfiles import StaticFiles
-from database.mongodb import check_subtitles_task, save_subtitles_task
+from database.mongodb import check_subtitles_task, get_slice_subtitles_from_mongodb, get_transcript_job_from_mongodb, save_subtitles_task
+from uploads import UploadOffsetError, append_upload, create_upload, expire_uploads, finish_upload, get_upload, get_upload_offset
 
-from worker import get_subtitles_recos, get_subtitles_summary, get_subtitles_translation, transcript_file_task_add, transcript_task_add
-from worker import celery
+from ai_request.transcribe import free_concurrency, transcribe_slices
+from worker import get_subtitles_recos, get_subtitles_summary, get_subtitles_translation, transcript_file_task_add, transcript_task_add, transcript_task_resume
+from worker import celery, queue_depths, transcript_queue
 
 load_dotenv()
 
 VOLUME_PATH = os.environ.get('RAILWAY_VOLUME_MOUNT_PATH', '/external')
-OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "_")
 ALLOWED_EXTENSIONS = {'mp3', 'mp4', 'mpeg', 'mpga', 'm4a', 'wav', 'webm'}
 ONE_MINUTE = 1000*60
+TASK_EVENTS_INTERVAL = 1
+TASK_EVENTS_PENDING_TIMEOUT = int(
+    os.environ.get('TASK_EVENTS_PENDING_TIMEOUT', 5 * 60))
 app = FastAPI()
 
 app.mount("/files", StaticFiles(directory=VOLUME_PATH), name="files")
@@ -82,6 +87,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Location", "Upload-Offset", "Upload-Length"],
 )
 
 
@@ -90,46 +96,29 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def slice_audio(audio, slice_duration):
-    startTime = datetime.now()
-    slices = []
-    duration = len(audio)
-    start = 0
-    end = slice_duration
-
-    while start <= duration:
-        slices.append(audio[start:end])
-        start += slice_duration
-        end += slice_duration
-
-    endTime = datetime.now()
-    print('Slicing took', endTime - startTime)
-    return slices
-
-
-def zip_audios(sliced_audios):
-    # Combine the sliced audio files into a single response
-    with io.BytesIO() as zip_buffer:
-        start_time = datetime.now()
-        with zipfile.ZipFile(zip_buffer, 'w', compression=zipfile.ZIP_DEFLATED) as zipf:
-            for idx, audio in enumerate(sliced_audios):
-                slice_io = io.BytesIO()
-                audio.export(slice_io, format="mp3")
-                slice_io.seek(0)
-                zipf.writestr(f'slice_{idx+1}.mp3', slice_io.read())
-        zip_buffer.seek(0)
-        end_time = datetime.now()
-        print('Zip took', end_time - start_time)
-        return zip_buffer.read()
-
-
-def export_mp3(audio):
-    start_time = datetime.now()
-    filename = '/tmp/' + str(uuid.uuid4()) + '.mp3'
-    audio.export(filename, format="mp3")
-    end_time = datetime.now()
-    print('Audio saved', filename,  end_time - start_time, sep="---")
-    return filename
+def slice_file(filename):
+    """
+    Probe and find boundaries up front, then return a generator that yields
+    slices as they are cut and removes the source file when done. Slices are
+    as long as the whisper upload limit allows.
+    """
+    try:
+        info = probe_audio(filename)
+        print('Audio length:', info['duration'])
+        slice_count = min_slice_count(
+            info['duration'], slice_bit_rate(info), SILENCE_TOLERANCE)
+        boundaries = find_silence_boundaries(
+            filename, info['duration'], slice_count)
+    except Exception:
+        os.remove(filename)
+        raise
+
+    def slices():
+        try:
+            yield from iter_segments(filename, info, boundaries)
+        finally:
+            os.remove(filename)
+    return slices()
 
 
 def save_file(file: UploadFile):
@@ -144,15 +133,6 @@ def save_file(file: UploadFile):
     return filename
 
 
-def transcribe_audio(filename, format, prompt):
-    print('Request openapi', filename, format, prompt, sep="---")
-    with open(filename, "rb") as f:
-        transcript = openai.Audio.transcribe(
-            "whisper-1", f, api_key=OPENAI_API_KEY, response_format=format, prompt=prompt)
-        os.remove(filename)
-        return transcript
-
-
 def get_youtube_audio_url(link):
     print('Transcribing youtube', link)
     yt = YouTube(link)
@@ -166,41 +146,68 @@ def get_youtube_audio_url(link):
 @app.post('/upload')
 def upload_file(file: UploadFile):
     if file and allowed_file(file.filename):
-        audio = AudioSegment.from_file(file.file)
-        print('audio length:', len(audio))
-        # Slice into max 20-minute chunks
-        sliced_audios = slice_audio(audio, 20 * 60 * 1000)
-        zip = zip_audios(sliced_audios)
+        sliced_audios = slice_file(spool_file(file.file))
         logging.info('Request sent')
-        return StreamingResponse(io.BytesIO(zip), headers={'Content-Disposition': 'attachment; filename=audio.zip', "Content-Type": "application/zip"})
+        return StreamingResponse(stream_zip(sliced_audios), headers={'Content-Disposition': 'attachment; filename=audio.zip', "Content-Type": "application/zip"})
 
     else:
         raise HTTPException(status_code=404, detail="Invalid audio file")
 
 
 @app.get('/download')
-async def fetch_and_slice_audio(url):
+def fetch_and_slice_audio(url):
     print('Downloading:', url)
-    # Initialize the bytearray
-    response = requests.get(url, stream=True)
-    total_size = int(response.headers.get('content-length', 0))
-
-    # Initialize the bytearray
-    content = bytearray()
-
-    for data in tqdm(response.iter_content(chunk_size=1024 * 1024), total=total_size // 1024 / 1024, unit='MB', unit_scale=True):
-        content.extend(data)
-
-    if response.status_code == 200:
-        print('Audio downloaded')
-        audio = AudioSegment.from_file(io.BytesIO(content))
-        # Slice into max 20-minute chunks
-        sliced_audios = slice_audio(audio, 20 * 60 * 1000)
-        zip = zip_audios(sliced_audios)
-        print('Request sent')
-        return StreamingResponse(io.BytesIO(zip), headers={'Content-Disposition': 'attachment; filename=audio.zip', "Content-Type": "application/zip"})
-    else:
+    try:
+        filename = download_audio(url)
+    except DownloadError as ex:
+        logger.warning(str(ex))
         raise HTTPException(status_code=404, detail="Failed to fetch url")
+    print('Audio downloaded')
+    sliced_audios = slice_file(filename)
+    print('Request sent')
+    return StreamingResponse(stream_zip(sliced_audios), headers={'Content-Disposition': 'attachment; filename=audio.zip', "Content-Type": "application/zip"})
+
+
+def check_remote_credit(url, user):
+    """
+    Reject from the remote headers before downloading anything. Sources
+    ffprobe cannot read are checked again after download. Returns the
+    duration in ms when known.
+    """
+    duration = probe_duration(url)
+    if duration is None:
+        return
+    credit = get_user_credit(user['sub'])
+    if (round(duration / ONE_MINUTE) > credit):
+        raise HTTPException(status_code=404, detail="Insufficient credit")
+    return duration
+
+
+def transcribe_file(filename, user, format, prompt):
+    """
+    Check credit against the probed duration, then slice and transcribe.
+    Returns the transcript, with each slice moved to where it starts in the
+    audio, and the audio duration in ms.
+    """
+    try:
+        info = probe_audio(filename)
+        credit = get_user_credit(user['sub'])
+        duration = round(info['duration'] / ONE_MINUTE)
+        if (duration > credit):
+            raise HTTPException(status_code=404, detail="Insufficient credit")
+        # As many slices as can be transcribed at once, under the upload limit
+        slice_count = plan_slice_count(
+            info['duration'], slice_bit_rate(info, transcribe=True), free_concurrency(), SILENCE_TOLERANCE)
+        boundaries = find_silence_boundaries(
+            filename, info['duration'], slice_count)
+        sliced_audios = segment_audio(
+            filename, info, boundaries, transcribe=True)
+    finally:
+        os.remove(filename)
+    # Transcribe
+    results = transcribe_slices(sliced_audios, format, prompt)
+    merged = merge_cues(results, [audio.start for audio in sliced_audios])
+    return [render_cues(merged, format)], info['duration']
 
 
 @app.get('/transcript')
@@ -209,76 +216,34 @@ def transcript(url: str, current_user: Annotated[User, Depends(get_current_user)
         print('Youtube url', url)
         url = get_youtube_audio_url(url)
         print('Youtube audio url', url)
+    check_remote_credit(url, current_user)
     logger.info('Downloading: %s', url)
     logger.info('Srt format, %s', srt)
     try:
-        response = requests.get(url, stream=True)
-    except requests.exceptions.HTTPError as err:
+        filename = download_audio(url)
+    except DownloadError as ex:
+        logger.warning('Failed to download podcast, %s', str(ex))
         raise HTTPException(status_code=404, detail="Failed to fetch url")
 
-    total_size = int(response.headers.get('content-length', 0))
-
-    # Initialize the bytearray
-    content = bytearray()
-
-    for data in tqdm(response.iter_content(chunk_size=1024 * 1024), total=total_size // 1024 / 1024, unit='MB', unit_scale=True):
-        content.extend(data)
-
-    if response.status_code == 200:
-        logger.info('Audio downloaded')
-        credit = get_user_credit(current_user['sub'])
-        audio = AudioSegment.from_file(io.BytesIO(content))
-        duration = round(len(audio) / ONE_MINUTE)
-        if (duration > credit):
-            raise HTTPException(status_code=404, detail="Insufficient credit")
-        format = 'srt' if srt else 'text'
-        # Slice into max 20-minute chunks
-        sliced_audios = slice_audio(audio, 20 * 60 * 1000)
-        # Save files in /tmp
-        files = []
-        for audio in sliced_audios:
-            print('Audio length:', len(audio))
-            files.append(export_mp3(audio))
-        # Transcribe
-        results = []
-        inputs = list(map(lambda file: (file, format, prompt), files))
-        with multiprocessing.Pool(processes=len(inputs)) as pool:
-            results = pool.starmap(transcribe_audio, inputs)
-        # Update user credit
-        update_user_credit(
-            current_user['sub'], -duration, len(audio), title, 'podcast')
-        print('Request sent')
-        return results
-    else:
-        logger.warning('Failed to download podcast')
-        raise HTTPException(status_code=404, detail="Failed to fetch url")
+    logger.info('Audio downloaded')
+    format = 'srt' if srt else 'text'
+    results, length = transcribe_file(filename, current_user, format, prompt)
+    # Update user credit
+    update_user_credit(
+        current_user['sub'], -round(length / ONE_MINUTE), length, title, 'podcast')
+    print('Request sent')
+    return results
 
 
 @app.post('/transcript')
 def transcript_file(file: UploadFile,  current_user: Annotated[User, Depends(get_current_user)], prompt:  Annotated[str, Form()] = '', srt: Annotated[bool, Form()] = False):
     if file and allowed_file(file.filename):
-        credit = get_user_credit(current_user['sub'])
-        audio = AudioSegment.from_file(file.file)
-        duration = round(len(audio) / ONE_MINUTE)
-        if (duration > credit):
-            raise HTTPException(status_code=404, detail="Insufficient credit")
         format = 'srt' if srt else 'text'
-        print('Audio length:', len(audio))
-        # Slice into max 20-minute chunks
-        sliced_audios = slice_audio(audio, 20 * 60 * 1000)
-        # Export audio files
-        files = []
-        for audio in sliced_audios:
-            print('Audio length:', len(audio))
-            files.append(export_mp3(audio))
-        results = []
-        # Transcribe
-        inputs = list(map(lambda file: (file, format, prompt), files))
-        with multiprocessing.Pool(processes=len(inputs)) as pool:
-            results = pool.starmap(transcribe_audio, inputs)
+        results, length = transcribe_file(
+            spool_file(file.file), current_user, format, prompt)
         # Update user credit
         update_user_credit(
-            current_user['sub'], -duration, len(audio), file.filename, 'audio')
+            current_user['sub'], -round(length / ONE_MINUTE), length, file.filename, 'audio')
         print('Request sent')
         return results
     else:
@@ -287,59 +252,138 @@ def transcript_file(file: UploadFile,  current_user: Annotated[User, Depends(get
 
 @app.get("/transcript-task")
 def transcript_task(url: str, current_user: Annotated[User, Depends(get_current_user)], title: str = '', srt: bool = False, prompt: str = '', type: str = 'podcast', image: str = ""):
-    task = transcript_task_add.delay(
-        url, current_user, srt, prompt, type)
+    duration = None
+    if (type != 'youtube'):
+        duration = check_remote_credit(url, current_user)
+    task = transcript_task_add.apply_async(
+        (url, current_user, srt, prompt, type), queue=transcript_queue(duration))
     add_credit_record(task.id, current_user['sub'], title, type, url, image)
     return JSONResponse({"task_id": task.id})
 
 
+def add_file_task(filename, name, current_user, srt, prompt):
+    """
+    Queue transcription of a file saved under VOLUME_PATH, the worker reads
+    it from the shared volume.
+    """
+    duration = probe_duration(VOLUME_PATH + '/' + filename)
+    if (round((duration or 0) / ONE_MINUTE) > get_user_credit(current_user['sub'])):
+        raise HTTPException(status_code=404, detail="Insufficient credit")
+    task = transcript_file_task_add.apply_async(
+        (filename, current_user, srt, prompt), queue=transcript_queue(duration))
+    add_credit_record(
+        task.id, current_user['sub'], name, 'audio', filename)
+    return task.id
+
+
 @app.post("/transcript-task")
-async def transcript_file_task(file: UploadFile, current_user: Annotated[User, Depends(get_current_user)], prompt:  Annotated[str, Form()] = '', srt: Annotated[bool, Form()] = False):
+def transcript_file_task(file: UploadFile, current_user: Annotated[User, Depends(get_current_user)], prompt:  Annotated[str, Form()] = '', srt: Annotated[bool, Form()] = False):
     if file and allowed_file(file.filename):
         filename = 'audio.mp3' if file.filename is None else file.filename
         file_extension = os.path.splitext(filename)[1]
         file_name = os.path.splitext(filename)[0]
-        file_bytes = await file.read()
         id = str(uuid.uuid4())
         if file.filename is None:
             return
         filename = id + file_extension
         with open(VOLUME_PATH + '/' + filename, "wb+") as file_object:
-            shutil.copyfileobj(io.BytesIO(file_bytes), file_object)
+            shutil.copyfileobj(file.file, file_object)
             print('Audio saved', filename)
-        task = transcript_file_task_add.delay(
-            file_bytes, current_user, srt, prompt)
-        add_credit_record(
-            task.id, current_user['sub'], file_name, 'audio', filename)
-        return JSONResponse({"task_id": task.id})
+        try:
+            task_id = add_file_task(filename, file_name, current_user, srt, prompt)
+        except Exception:
+            os.remove(VOLUME_PATH + '/' + filename)
+            raise
+        return JSONResponse({"task_id": task_id})
     else:
         raise HTTPException(status_code=404, detail="File not support")
 
 
+@app.post("/uploads")
+async def create_resumable_upload(current_user: Annotated[User, Depends(get_current_user)], name: Annotated[str, Form()], length: Annotated[int, Form()], prompt:  Annotated[str, Form()] = '', srt: Annotated[bool, Form()] = False):
+    if not allowed_file(name) or length <= 0:
+        raise HTTPException(status_code=404, detail="File not support")
+    if length > MAX_DOWNLOAD_SIZE:
+        raise HTTPException(status_code=413, detail="File too large")
+    # Abandoned uploads are swept whenever a new one starts
+    await run_in_threadpool(expire_uploads)
+    upload = await create_upload(current_user['sub'], name, length, prompt, srt)
+    return JSONResponse({"upload_id": upload['id']}, headers={'Location': f"/uploads/{upload['id']}", 'Upload-Offset': '0'})
+
+
+async def get_user_upload(upload_id, current_user):
+    upload = await get_upload(upload_id)
+    if upload is None or upload['user_id'] != current_user['sub']:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return upload
+
+
+@app.head("/uploads/{upload_id}")
+async def get_resumable_upload_offset(upload_id: str, current_user: Annotated[User, Depends(get_current_user)]):
+    upload = await get_user_upload(upload_id, current_user)
+    offset = await get_upload_offset(upload)
+    return Response(headers={'Upload-Offset': str(offset), 'Upload-Length': str(upload['length']), 'Cache-Control': 'no-store'})
+
+
+@app.patch("/uploads/{upload_id}")
+async def append_resumable_upload(upload_id: str, request: Request, current_user: Annotated[User, Depends(get_current_user)], upload_offset: Annotated[int, Header()]):
+    """
+    Append the request body at Upload-Offset. Clients that lose the
+    connection ask HEAD for the offset and resume from there. The
+    transcription task is queued once the last byte arrives. The upload is
+    kept until the task is queued, so a rejected one can be sent again.
+    """
+    upload = await get_user_upload(upload_id, current_user)
+    try:
+        offset = await append_upload(upload, upload_offset, request.stream())
+    except UploadOffsetError as ex:
+        raise HTTPException(status_code=409, detail=str(ex))
+    if offset < upload['length']:
+        return Response(status_code=204, headers={'Upload-Offset': str(offset)})
+    print('Audio saved', upload['filename'])
+    task_id = await run_in_threadpool(
+        add_file_task, upload['filename'], upload['name'], current_user, upload['srt'], upload['prompt'])
+    await finish_upload(upload)
+    return JSONResponse({"task_id": task_id}, headers={'Upload-Offset': str(offset)})
+
+
 @app.get("/transcript-task/retry/{id}")
-async def transcript_task_retry(current_user: Annotated[User, Depends(get_current_user)], id: str):
+def transcript_task_retry(current_user: Annotated[User, Depends(get_current_user)], id: str):
     record = get_credit_record(id)
     if record is None:
         raise HTTPException(status_code=404, detail="Task not support")
     logger.info(record)
-    if record["type"] == "audio":
-        filename = record['audio_url']
-        with open(VOLUME_PATH + '/' + filename, "wb+") as file_object:
-            file_bytes = file_object.read()
-            print('Audio loaded', filename)
-        task = transcript_file_task_add.delay(
-            file_bytes, current_user, True, record["prompt"])
+    job = get_transcript_job_from_mongodb(record["task_id"])
+    if job is not None:
+        # Resuming re-keys the job, which a running chord would write past
+        if celery.AsyncResult(record["task_id"]).state != 'FAILURE':
+            raise HTTPException(status_code=409, detail="Task is still running")
+        # Only the slices that did not finish are transcribed again
+        task = transcript_task_resume.apply_async(
+            (record["task_id"], current_user), queue=transcript_queue(job['duration']))
+        update_credit_record_task_id(
+            id, task.id, )
+    elif record["type"] == "audio":
+        duration = probe_duration(VOLUME_PATH + '/' + record['audio_url'])
+        task = transcript_file_task_add.apply_async(
+            (record['audio_url'], current_user, True, record["prompt"]), queue=transcript_queue(duration))
         update_credit_record_task_id(
             id, task.id, )
     else:
         audio_url = record['audio_url']
-        task = transcript_task_add.delay(
-            audio_url, current_user, True, record["prompt"], record["type"])
+        duration = None if record["type"] == 'youtube' else probe_duration(audio_url)
+        task = transcript_task_add.apply_async(
+            (audio_url, current_user, True, record["prompt"], record["type"]), queue=transcript_queue(duration))
         update_credit_record_task_id(
             id, task.id, )
 
     return JSONResponse({"task_id": task.id})
 
+@app.get("/queues")
+def get_queues():
+    return JSONResponse(queue_depths())
+
+
 @app.get("/tasks/{task_id}")
 def get_status(task_id):
     task_result = celery.AsyncResult(task_id)
@@ -351,6 +395,57 @@ def get_status(task_id):
     return JSONResponse(result)
 
 
+def task_state(task_id):
+    task_result = celery.AsyncResult(task_id)
+    status = task_result.status
+    progress = task_result.info if status == 'PROGRESS' else {}
+    return status, progress, task_result.ready()
+
+
+async def task_events(task_id):
+    """
+    Poll the task without holding a threadpool thread between polls. A task
+    that stays PENDING, unknown or never started, ends the stream after
+    TASK_EVENTS_PENDING_TIMEOUT seconds.
+    """
+    sent = []
+    pending_since = time.monotonic()
+    while True:
+        task_status, progress, ready = await run_in_threadpool(task_state, task_id)
+        done = progress.get('done', [])
+        new_slices = [index for index in done if index not in sent]
+        if len(new_slices) > 0:
+            subtitles = await run_in_threadpool(get_slice_subtitles_from_mongodb, task_id, new_slices)
+            sent.extend(new_slices)
+            yield f"event: subtitles\ndata: {json.dumps(subtitles)}\n\n"
+        status = {
+            "task_status": task_status,
+            "done": len(done),
+            "total": progress.get('total')
+        }
+        yield f"event: progress\ndata: {json.dumps(status)}\n\n"
+        if ready:
+            yield f"event: done\ndata: {json.dumps(status)}\n\n"
+            return
+        if task_status != 'PENDING':
+            pending_since = time.monotonic()
+        elif time.monotonic() - pending_since > TASK_EVENTS_PENDING_TIMEOUT:
+            yield f"event: error\ndata: {json.dumps({**status, 'detail': 'Task not started'})}\n\n"
+            return
+        await asyncio.sleep(TASK_EVENTS_INTERVAL)
+
+
+@app.get("/tasks/{task_id}/events")
+async def get_status_events(task_id):
+    """
+    Server sent events for a transcription task: progress, subtitles of each
+    slice as it finishes, and done. Subtitle ids are numbered per slice
+    until the task is done, clients order by slice then id and fetch the
+    final list after done.
+    """
+    return StreamingResponse(task_events(task_id), media_type="text/event-stream", headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.get("/subtitles/translate/{task_id}")
 def get_subtitles(task_id, current_user: Annotated[User, Depends(get_current_user)]):
     user_id = current_user['sub']
@@ -0,0 +1,62 @@
+import io
+import os
+import zipfile
+from typing import Iterable, Iterator
+from audio.segment import AudioSlice
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class ZipStream(io.RawIOBase):
+    """
+    Unseekable sink for zipfile that hands written bytes back on drain, so
+    zipfile falls back to data descriptors and never seeks back.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def stream_zip(sliced_audios: Iterable[AudioSlice]) -> Iterator[bytes]:
+    """
+    Yield a zip archive of the slices chunk by chunk as each slice becomes
+    available, removing slice files once written. Slices are already
+    compressed audio, so entries are stored rather than deflated.
+    """
+    stream = ZipStream()
+    sliced_audios = iter(sliced_audios)
+    audio = None
+    try:
+        with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_STORED) as zipf:
+            for idx, audio in enumerate(sliced_audios):
+                extension = os.path.splitext(audio.path)[1]
+                with open(audio.path, 'rb') as src, zipf.open(f'slice_{idx+1}{extension}', 'w') as dest:
+                    while True:
+                        data = src.read(CHUNK_SIZE)
+                        if not data:
+                            break
+                        dest.write(data)
+                        yield stream.drain()
+                os.remove(audio.path)
+                audio = None
+        yield stream.drain()
+    finally:
+        # On a disconnect remove the slice being written, and close the
+        # source so it removes the slices it has not handed out
+        if audio is not None and os.path.exists(audio.path):
+            os.remove(audio.path)
+        close = getattr(sliced_audios, 'close', None)
+        if close is not None:
+            close()
@@ -0,0 +1,66 @@
+import os
+import subprocess
+from datetime import datetime
+from typing import List
+import numpy as np
+from utils import logger
+
+SAMPLE_RATE = 16000
+# Length of one RMS frame and of the quiet stretch we look for, in ms
+FRAME_DURATION = 20
+GAP_DURATION = 300
+# Width of the window around each target offset a cut may move within, in ms
+SILENCE_TOLERANCE = int(os.environ.get('SILENCE_TOLERANCE', 20 * 1000))
+
+
+def decode_window(filename: str, start: int, duration: int) -> np.ndarray:
+    """
+    Decode duration ms of audio from start as mono 16 kHz samples.
+    """
+    command = [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error',
+        '-ss', str(start / 1000), '-t', str(duration / 1000), '-i', filename,
+        '-map', '0:a:0', '-ac', '1', '-ar', str(SAMPLE_RATE), '-f', 's16le', '-'
+    ]
+    result = subprocess.run(command, capture_output=True)
+    if result.returncode != 0:
+        return np.zeros(0, dtype=np.int16)
+    return np.frombuffer(result.stdout, dtype=np.int16)
+
+
+def quietest_offset(samples: np.ndarray) -> int | None:
+    """
+    Offset in ms of the middle of the quietest GAP_DURATION stretch, measured
+    as short window RMS energy.
+    """
+    frame_size = SAMPLE_RATE * FRAME_DURATION // 1000
+    frame_count = len(samples) // frame_size
+    gap_frames = GAP_DURATION // FRAME_DURATION
+    if frame_count < gap_frames:
+        return None
+    frames = samples[:frame_count * frame_size].astype(np.float32)
+    frames = frames.reshape(frame_count, frame_size)
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    energy = np.convolve(rms, np.ones(gap_frames), mode='valid')
+    quietest = int(np.argmin(energy))
+    return (quietest + gap_frames // 2) * FRAME_DURATION
+
+
+def find_silence_boundaries(filename: str, duration: int, slice_count: int, tolerance: int = SILENCE_TOLERANCE) -> List[int]:
+    """
+    Pick cut points splitting the audio into slice_count near equal slices,
+    each moved to the quietest moment in a tolerance ms window centered on
+    its target, so no slice is more than tolerance ms longer than an even
+    split. Only the windows around the targets are decoded.
+    """
+    start_time = datetime.now()
+    tolerance = min(tolerance, duration // slice_count // 2)
+    boundaries = []
+    for index in range(1, slice_count):
+        target = duration * index // slice_count
+        window_start = target - tolerance // 2
+        offset = quietest_offset(decode_window(filename, window_start, tolerance))
+        boundaries.append(target if offset is None else window_start + offset)
+    end_time = datetime.now()
+    logger.info(f'found {len(boundaries)} boundaries in {end_time - start_time}')
+    return boundaries
@@ -0,0 +1,84 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import requests
+from tqdm import tqdm
+from utils import logger
+
+DOWNLOAD_PATH = os.environ.get('DOWNLOAD_PATH', '/tmp')
+# Refuse remote audio larger than this, 1 GB by default
+MAX_DOWNLOAD_SIZE = int(os.environ.get('MAX_DOWNLOAD_SIZE', 1024)) * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadError(Exception):
+    pass
+
+
+def download_audio(url: str, max_size: int = MAX_DOWNLOAD_SIZE) -> str:
+    """
+    Stream remote audio into a temp file and return its path, so ffmpeg can
+    read it from disk instead of from memory. The caller removes the file.
+    """
+    try:
+        response = requests.get(url, stream=True, timeout=30)
+    except requests.exceptions.RequestException as ex:
+        raise DownloadError(f'Failed to fetch audio, {str(ex)}')
+    with response:
+        if response.status_code != 200:
+            raise DownloadError(
+                f'Failed to fetch audio, status {response.status_code}')
+        total_size = int(response.headers.get('content-length', 0))
+        if total_size > max_size:
+            raise DownloadError(f'Audio too large, {total_size} bytes')
+        fd, filename = tempfile.mkstemp(dir=DOWNLOAD_PATH, suffix='.audio')
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for data in tqdm(response.iter_content(chunk_size=CHUNK_SIZE), total=total_size // CHUNK_SIZE, unit='MB', unit_scale=True):
+                    size += len(data)
+                    if size > max_size:
+                        raise DownloadError(f'Audio too large, over {max_size} bytes')
+                    f.write(data)
+        except BaseException:
+            os.remove(filename)
+            raise
+    logger.info(f'audio downloaded {filename}, {size} bytes')
+    return filename
+
+
+def spool_file(file, suffix: str = '.audio') -> str:
+    """
+    Copy an uploaded file object into a temp file and return its path.
+    """
+    fd, filename = tempfile.mkstemp(dir=DOWNLOAD_PATH, suffix=suffix)
+    with os.fdopen(fd, 'wb') as f:
+        shutil.copyfileobj(file, f, CHUNK_SIZE)
+    return filename
+
+
+def remote_fingerprint(url: str) -> str | None:
+    """
+    Identify remote audio by url and its ETag or Last-Modified header, or
+    None when the server sends neither.
+    """
+    try:
+        response = requests.head(url, allow_redirects=True, timeout=10)
+    except requests.exceptions.RequestException:
+        return None
+    validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+    if response.status_code != 200 or validator is None:
+        return None
+    return f'{url} {validator}'
+
+
+def file_fingerprint(filename: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            sha256.update(data)
+    return sha256.hexdigest()
@@ -0,0 +1,51 @@
+import math
+import os
+
+# Whisper API rejects uploads over 25 MB, keep some room for container overhead
+UPLOAD_LIMIT = int(os.environ.get('WHISPER_UPLOAD_LIMIT', 25 * 1024 * 1024))
+UPLOAD_HEADROOM = 0.9
+# Most slices of one job transcribed side by side
+TRANSCRIPTION_PARALLELISM = int(os.environ.get('TRANSCRIPTION_PARALLELISM', 8))
+MIN_SLICE_DURATION = int(os.environ.get('MIN_SLICE_DURATION', 2 * 60 * 1000))
+# Fixed cost of one transcription request in ms, and how many times faster
+# than real time a slice is transcribed, for estimating completion time
+SLICE_OVERHEAD = int(os.environ.get('SLICE_OVERHEAD', 5000))
+TRANSCRIBE_SPEEDUP = float(os.environ.get('TRANSCRIBE_SPEEDUP', 20))
+
+
+def max_slice_duration(bit_rate: int, upload_limit: int = UPLOAD_LIMIT) -> int:
+    """
+    Longest slice in ms whose encoded size stays under the upload limit.
+    """
+    return math.floor(upload_limit * UPLOAD_HEADROOM * 8 * 1000 / bit_rate)
+
+
+def min_slice_count(duration: int, bit_rate: int, slack: int = 0) -> int:
+    """
+    Fewest near equal slices that stay under the upload limit when a cut
+    may lengthen a slice by up to slack ms.
+    """
+    return max(1, math.ceil(duration / (max_slice_duration(bit_rate) - slack)))
+
+
+def expected_completion(duration: int, slice_count: int, concurrency: int) -> float:
+    """
+    Estimated ms to transcribe duration ms of audio as slice_count equal
+    slices, with concurrency slices in flight at a time.
+    """
+    rounds = math.ceil(slice_count / concurrency)
+    return rounds * (SLICE_OVERHEAD + duration / slice_count / TRANSCRIBE_SPEEDUP)
+
+
+def plan_slice_count(duration: int, bit_rate: int, concurrency: int = TRANSCRIPTION_PARALLELISM, slack: int = 0) -> int:
+    """
+    Number of near equal slices that finishes soonest given the free
+    transcription concurrency, the fewest on a tie. Slices stay under the
+    upload limit and, when the limit allows, no shorter than
+    MIN_SLICE_DURATION.
+    """
+    concurrency = max(1, min(concurrency, TRANSCRIPTION_PARALLELISM))
+    fewest = min_slice_count(duration, bit_rate, slack)
+    most = max(fewest, duration // MIN_SLICE_DURATION)
+    return min(range(fewest, most + 1),
+               key=lambda slice_count: expected_completion(duration, slice_count, concurrency))
@@ -0,0 +1,96 @@
+import json
+import os
+import subprocess
+
+# Seconds to wait for ffprobe, which may be reading headers over HTTP
+PROBE_TIMEOUT = int(os.environ.get('PROBE_TIMEOUT', 30))
+
+
+class ProbeError(Exception):
+    pass
+
+
+def is_remote(source: str) -> bool:
+    return source.startswith(('http://', 'https://'))
+
+
+def parse_progress_duration(progress: str) -> int | None:
+    """
+    Last out_time_us reported by ffmpeg -progress, in ms.
+    """
+    duration = None
+    for line in progress.splitlines():
+        key, _, value = line.partition('=')
+        if key == 'out_time_us' and value.strip().isdigit():
+            duration = round(int(value) / 1000)
+    return duration
+
+
+def measure_duration(filename: str) -> int:
+    """
+    Duration in ms of the first audio stream found by decoding it, for
+    files whose headers carry none, like MediaRecorder webm.
+    """
+    command = [
+        'ffmpeg', '-hide_banner', '-v', 'error', '-nostats', '-i', filename,
+        '-map', '0:a:0', '-f', 'null', '-progress', 'pipe:1', '-'
+    ]
+    result = subprocess.run(command, capture_output=True, text=True)
+    duration = parse_progress_duration(result.stdout)
+    if result.returncode != 0 or duration is None:
+        raise ProbeError(f'Unknown duration for {filename}')
+    return duration
+
+
+def probe_audio(source: str, decode: bool = True) -> dict:
+    """
+    Read codec, duration (ms) and bit rate of the first audio stream from the
+    container headers with ffprobe, without decoding any audio. The source
+    can be a path or an http(s) url, in which case ffprobe only fetches the
+    header bytes, using range requests when the index is at the end. Local
+    files without a duration in their headers are decoded to measure it,
+    unless decode is False.
+    """
+    command = [
+        'ffprobe', '-v', 'error', '-print_format', 'json',
+        '-rw_timeout', str(PROBE_TIMEOUT * 1000 * 1000),
+        '-show_format', '-show_streams', '-select_streams', 'a:0', source
+    ]
+    try:
+        result = subprocess.run(command, capture_output=True,
+                                text=True, timeout=PROBE_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        raise ProbeError(f'Timed out probing {source}')
+    if result.returncode != 0:
+        raise ProbeError(result.stderr.strip())
+    info = json.loads(result.stdout)
+    streams = info.get('streams', [])
+    if len(streams) == 0:
+        raise ProbeError(f'No audio stream found in {source}')
+    stream = streams[0]
+    container = info.get('format', {})
+    duration = stream.get('duration') or container.get('duration')
+    if duration is not None:
+        duration = round(float(duration) * 1000)
+    elif decode and not is_remote(source):
+        duration = measure_duration(source)
+    else:
+        raise ProbeError(f'Unknown duration for {source}')
+    bit_rate = stream.get('bit_rate') or container.get('bit_rate') or 0
+    return {
+        'codec': stream.get('codec_name'),
+        'format': container.get('format_name'),
+        'duration': duration,
+        'bit_rate': int(bit_rate),
+    }
+
+
+def probe_duration(source: str) -> int | None:
+    """
+    Duration in ms, or None when it cannot be read from the headers. Used for
+    quick credit checks, so nothing is decoded.
+    """
+    try:
+        return probe_audio(source, decode=False)['duration']
+    except ProbeError:
+        return None
@@ -0,0 +1,168 @@
+import csv
+import os
+import subprocess
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Iterator, List, NamedTuple
+from audio.download import DOWNLOAD_PATH
+from utils import logger
+
+# Codecs whisper accepts as is, with the container each slice is written in
+COPY_CODECS = {
+    'mp3': ('mp3', 'mp3'),
+    'aac': ('ipod', 'm4a'),
+    'opus': ('webm', 'webm'),
+    'vorbis': ('webm', 'webm'),
+}
+# Re-encode instead of stream copying slices for transcription above this
+TRANSCRIPTION_COPY_MAX_BIT_RATE = int(
+    os.environ.get('TRANSCRIPTION_COPY_MAX_BIT_RATE', 64000))
+# Mono 16 kHz is what whisper resamples to anyway, a low bit rate keeps
+# uploads small without hurting accuracy
+TRANSCRIPTION_BIT_RATE = int(os.environ.get('TRANSCRIPTION_BIT_RATE', 32000))
+TRANSCRIPTION_ENCODE_ARGS = [
+    '-ac', '1', '-ar', '16000', '-c:a', 'libmp3lame', '-b:a', str(TRANSCRIPTION_BIT_RATE)
+]
+DOWNLOAD_BIT_RATE = 128000
+DOWNLOAD_ENCODE_ARGS = ['-c:a', 'libmp3lame', '-b:a', str(DOWNLOAD_BIT_RATE)]
+# Each slice is encoded by its own single threaded ffmpeg process
+ENCODE_WORKERS = int(os.environ.get('ENCODE_WORKERS', os.cpu_count() or 1))
+
+encode_executor = ThreadPoolExecutor(max_workers=ENCODE_WORKERS)
+
+
+class AudioSlice(NamedTuple):
+    path: str
+    start: int
+    end: int
+
+
+class SegmentError(Exception):
+    pass
+
+
+def can_stream_copy(info: dict, transcribe: bool = False) -> bool:
+    if info['codec'] not in COPY_CODECS:
+        return False
+    return not transcribe or info['bit_rate'] <= TRANSCRIPTION_COPY_MAX_BIT_RATE
+
+
+def slice_bit_rate(info: dict, transcribe: bool = False) -> int:
+    """
+    Bit rate the slices will be written with.
+    """
+    if can_stream_copy(info, transcribe):
+        return info['bit_rate'] or DOWNLOAD_BIT_RATE
+    return TRANSCRIPTION_BIT_RATE if transcribe else DOWNLOAD_BIT_RATE
+
+
+def copy_segments(filename: str, codec: str, boundaries: List[int], output_path: str) -> List[AudioSlice]:
+    """
+    Stream copy audio into slices with ffmpeg's segment muxer. Start and end
+    of each slice come from the segment list, since copied slices can only
+    be cut on packet boundaries.
+    """
+    segment_format, extension = COPY_CODECS[codec]
+    if len(boundaries) > 0:
+        split_args = ['-segment_times',
+                      ','.join(str(boundary / 1000) for boundary in boundaries)]
+    else:
+        # A single slice, longer than any audio we accept
+        split_args = ['-segment_time', str(24 * 60 * 60)]
+    prefix = os.path.join(output_path, str(uuid.uuid4()))
+    segment_list = prefix + '.csv'
+    command = [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', filename,
+        '-map', '0:a:0', '-vn', '-c', 'copy',
+        '-f', 'segment', *split_args,
+        '-segment_format', segment_format, '-reset_timestamps', '1',
+        '-segment_list', segment_list, '-segment_list_type', 'csv',
+        f'{prefix}_%03d.{extension}'
+    ]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise SegmentError(result.stderr.strip())
+    slices = []
+    with open(segment_list, newline='') as f:
+        for name, start, end in csv.reader(f):
+            slices.append(AudioSlice(
+                os.path.join(output_path, name),
+                round(float(start) * 1000),
+                round(float(end) * 1000)))
+    os.remove(segment_list)
+    return slices
+
+
+def encode_slice(filename: str, start: int, end: int, encode_args: List[str], output_path: str) -> AudioSlice:
+    path = os.path.join(output_path, str(uuid.uuid4()) + '.mp3')
+    command = [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error',
+        '-ss', str(start / 1000), '-i', filename, '-t', str((end - start) / 1000),
+        '-map', '0:a:0', '-vn', *encode_args, path
+    ]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise SegmentError(result.stderr.strip())
+    return AudioSlice(path, start, end)
+
+
+def remove_slice(audio: AudioSlice):
+    try:
+        os.remove(audio.path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_encoded_slice(future: Future):
+    if not future.cancelled() and future.exception() is None:
+        remove_slice(future.result())
+
+
+def iter_segments(filename: str, info: dict, boundaries: List[int], transcribe: bool = False, output_path: str = DOWNLOAD_PATH) -> Iterator[AudioSlice]:
+    """
+    Cut audio at the given offsets (ms) and yield the slices in order. Codecs
+    whisper accepts are stream copied in one pass, anything else is encoded
+    to mp3 one slice per process on the shared encode pool. Slices meant for
+    transcription are also re-encoded to the low bit rate transcription
+    profile when the source bit rate is high.
+    """
+    if can_stream_copy(info, transcribe):
+        slices = copy_segments(filename, info['codec'], boundaries, output_path)
+        position = 0
+        try:
+            for position, audio in enumerate(slices):
+                yield audio
+            position = len(slices)
+        finally:
+            # Closed early, slices not handed out yet are ours to remove
+            for audio in slices[position + 1:]:
+                remove_slice(audio)
+    else:
+        encode_args = TRANSCRIPTION_ENCODE_ARGS if transcribe else DOWNLOAD_ENCODE_ARGS
+        starts = [0, *boundaries]
+        ends = [*boundaries, info['duration']]
+        futures = [
+            encode_executor.submit(encode_slice, filename, start, end, encode_args, output_path)
+            for start, end in zip(starts, ends)
+        ]
+        position = 0
+        try:
+            for position, future in enumerate(futures):
+                yield future.result()
+            position = len(futures)
+        finally:
+            # Closed early, skip queued encodes and remove running ones once they finish
+            for future in futures[position + 1:]:
+                if not future.cancel():
+                    future.add_done_callback(remove_encoded_slice)
+
+
+def segment_audio(filename: str, info: dict, boundaries: List[int], transcribe: bool = False, output_path: str = DOWNLOAD_PATH) -> List[AudioSlice]:
+    start_time = datetime.now()
+    slices = list(iter_segments(
+        filename, info, boundaries, transcribe, output_path))
+    end_time = datetime.now()
+    logger.info(
+        f'segmenting {info["codec"]} into {len(slices)} slices took {end_time - start_time}')
+    return slices
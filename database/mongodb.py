@@ -1,5 +1,6 @@
 import asyncio
 import os
+from datetime import datetime
 from typing import List
 import motor.motor_asyncio
 from utils import logger
@@ -9,6 +10,13 @@ db = client.recos
 loop = asyncio.new_event_loop()
 asyncio.set_event_loop(loop)
 
+TRANSCRIPT_CACHE_TTL = int(os.environ.get(
+    'TRANSCRIPT_CACHE_TTL', 30 * 24 * 60 * 60))
+TRANSCRIPT_CACHE_SIZE = int(os.environ.get('TRANSCRIPT_CACHE_SIZE', 10000))
+# Checkpoints of jobs that are never resumed expire after this many seconds
+TRANSCRIPT_JOB_TTL = int(os.environ.get(
+    'TRANSCRIPT_JOB_TTL', 7 * 24 * 60 * 60))
+
 
 async def do_insert(srt_items: List[dict], task_id: str):
     for srt in srt_items:
@@ -23,7 +31,7 @@ async def do_update(srt_items: List[dict]):
 
 async def do_find(task_id: str):
     cursor = db.subtitle.find(
-        {'task_id': {'$eq': task_id}}).sort('subtitle_id')
+        {'task_id': {'$eq': task_id}}).sort([('slice', 1), ('id', 1)])
     result = []
     for document in await cursor.to_list(length=10000):  # type: ignore
         document.pop('_id')
@@ -31,6 +39,24 @@ async def do_find(task_id: str):
     return result
 
 
+async def do_find_slices(task_id: str, slices: List[int]):
+    cursor = db.subtitle.find(
+        {'task_id': {'$eq': task_id}, 'slice': {'$in': slices}}).sort([('slice', 1), ('id', 1)])
+    result = []
+    async for document in cursor:
+        document.pop('_id')
+        result.append(document)
+    return result
+
+
+async def do_renumber(task_id: str, counts: List[int]):
+    offset = 0
+    for index, count in enumerate(counts):
+        if count > 0:
+            await db.subtitle.update_many({'task_id': task_id, 'slice': index}, [{'$set': {'id': {'$add': ['$slice_id', offset]}}}])
+        offset += count
+
+
 def save_subtitle_result_to_mongodb(srt_items, task_id: str):
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
@@ -45,6 +71,25 @@ def update_subtitle_result_to_mongodb(srt_items):
     loop.run_until_complete(do_update(srt_items=srt_items))
 
 
+def get_slice_subtitles_from_mongodb(task_id: str, slices: List[int]):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop = client.get_io_loop()
+    return loop.run_until_complete(do_find_slices(task_id=task_id, slices=slices))
+
+
+def renumber_subtitles_in_mongodb(task_id: str, counts: List[int]):
+    """
+    Slices are saved with ids starting at 1, once all are in shift each
+    slice's ids past the subtitles of the slices before it. Ids are set
+    from the slice's own ids, so renumbering again changes nothing.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop = client.get_io_loop()
+    loop.run_until_complete(do_renumber(task_id=task_id, counts=counts))
+
+
 def get_subtitles_from_mongodb(task_id: str):
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
@@ -121,3 +166,139 @@ def check_subtitles_task(task: str, task_id: str):
     asyncio.set_event_loop(loop)
     loop = client.get_io_loop()
     return loop.run_until_complete(check_status(task, task_id))
+
+
+async def do_cache_find(keys: List[str]):
+    async for document in db.transcript_cache.find({'key': {'$in': keys}}).sort('created_at', -1):
+        # Entries outlive their subtitles when a task is deleted
+        if await db.subtitle.find_one({'task_id': document['task_id']}) is not None:
+            return document
+    return None
+
+
+async def do_cache_insert(keys: List[str], task_id: str, duration: int):
+    await db.transcript_cache.create_index('key')
+    await db.transcript_cache.create_index(
+        'created_at', expireAfterSeconds=TRANSCRIPT_CACHE_TTL)
+    now = datetime.utcnow()
+    for key in keys:
+        await db.transcript_cache.replace_one(
+            {'key': key},
+            {'key': key, 'task_id': task_id, 'duration': duration, 'created_at': now},
+            upsert=True)
+    overflow = await db.transcript_cache.count_documents({}) - TRANSCRIPT_CACHE_SIZE
+    if overflow > 0:
+        cursor = db.transcript_cache.find({}, {'_id': 1}).sort(
+            'created_at', 1).limit(overflow)
+        ids = [document['_id'] for document in await cursor.to_list(length=overflow)]
+        await db.transcript_cache.delete_many({'_id': {'$in': ids}})
+
+
+async def do_clone(from_task_id: str, to_task_id: str):
+    srt_items = await do_find(from_task_id)
+    for srt in srt_items:
+        srt.pop('default_translation_text', None)
+    if len(srt_items) > 0:
+        await do_insert(srt_items, to_task_id)
+    return len(srt_items)
+
+
+def get_cached_transcript(keys: List[str]):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop = client.get_io_loop()
+    return loop.run_until_complete(do_cache_find(keys))
+
+
+def save_cached_transcript(keys: List[str], task_id: str, duration: int):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop = client.get_io_loop()
+    loop.run_until_complete(do_cache_insert(keys, task_id, duration))
+
+
+def clone_subtitles_in_mongodb(from_task_id: str, to_task_id: str):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop = client.get_io_loop()
+    return loop.run_until_complete(do_clone(from_task_id, to_task_id))
+
+
+async def do_job_insert(job: dict, slices: List[dict], task_id: str):
+    for collection in [db.transcript_job, db.transcript_slice]:
+        await collection.create_index(
+            'created_at', expireAfterSeconds=TRANSCRIPT_JOB_TTL)
+    now = datetime.utcnow()
+    await db.transcript_job.insert_one({**job, 'task_id': task_id, 'created_at': now})
+    await db.transcript_slice.insert_many(
+        [{**item, 'task_id': task_id, 'created_at': now} for item in slices])
+
+
+async def do_job_find(task_id: str):
+    job = await db.transcript_job.find_one({'task_id': {'$eq': task_id}})
+    if job is None:
+        return None
+    job.pop('_id')
+    cursor = db.transcript_slice.find(
+        {'task_id': {'$eq': task_id}}).sort('index')
+    job['slices'] = []
+    async for document in cursor:
+        document.pop('_id')
+        job['slices'].append(document)
+    return job
+
+
+async def do_slice_update(task_id: str, index: int, fields: dict):
+    await db.transcript_slice.update_one({'task_id': task_id, 'index': index}, {'$set': fields})
+
+
+async def do_job_move(from_task_id: str, to_task_id: str):
+    # A resumed job gets a full TTL again
+    now = datetime.utcnow()
+    for collection in [db.transcript_job, db.transcript_slice]:
+        await collection.update_many({'task_id': from_task_id}, {'$set': {'task_id': to_task_id, 'created_at': now}})
+    await db.subtitle.update_many({'task_id': from_task_id}, {'$set': {'task_id': to_task_id}})
+
+
+async def do_job_delete(task_id: str):
+    await db.transcript_job.delete_many({'task_id': task_id})
+    await db.transcript_slice.delete_many({'task_id': task_id})
+
+
+def save_transcript_job_to_mongodb(job: dict, slices: List[dict], task_id: str):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop = client.get_io_loop()
+    loop.run_until_complete(do_job_insert(job, slices, task_id=task_id))
+
+
+def get_transcript_job_from_mongodb(task_id: str):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop = client.get_io_loop()
+    return loop.run_until_complete(do_job_find(task_id=task_id))
+
+
+def update_transcript_slice_to_mongodb(task_id: str, index: int, fields: dict):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop = client.get_io_loop()
+    loop.run_until_complete(do_slice_update(task_id, index, fields))
+
+
+def move_transcript_job_in_mongodb(from_task_id: str, to_task_id: str):
+    """
+    Hand a job's checkpoints and finished subtitles over to the task that
+    resumes it.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop = client.get_io_loop()
+    loop.run_until_complete(do_job_move(from_task_id, to_task_id))
+
+
+def delete_transcript_job_from_mongodb(task_id: str):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop = client.get_io_loop()
+    loop.run_until_complete(do_job_delete(task_id))
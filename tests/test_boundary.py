@@ -0,0 +1,30 @@
+import unittest
+
+try:
+    import numpy as np
+    from audio.boundary import GAP_DURATION, SAMPLE_RATE, quietest_offset
+except ImportError:
+    np = None
+
+
+def tone(duration):
+    t = np.arange(SAMPLE_RATE * duration // 1000) / SAMPLE_RATE
+    return (np.sin(2 * np.pi * 440 * t) * 10000).astype(np.int16)
+
+
+def silence(duration):
+    return np.zeros(SAMPLE_RATE * duration // 1000, dtype=np.int16)
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestBoundaryMethods(unittest.TestCase):
+    def test_quietest_offset_in_gap(self):
+        samples = np.concatenate([tone(2000), silence(500), tone(2000)])
+        offset = quietest_offset(samples)
+        assert offset is not None
+        # The middle of a silent GAP_DURATION stretch, well inside the gap
+        assert 2000 + GAP_DURATION // 3 <= offset <= 2500 - GAP_DURATION // 3
+
+    def test_quietest_offset_short_window(self):
+        assert quietest_offset(tone(GAP_DURATION - 20)) is None
+        assert quietest_offset(silence(0)) is None
@@ -0,0 +1,16 @@
+import unittest
+
+try:
+    from ai_request.utils import group_chunks
+except ImportError:
+    group_chunks = None
+
+
+@unittest.skipIf(group_chunks is None, "openai or tiktoken are not installed")
+class TestChunksMethods(unittest.TestCase):
+    def test_group_chunks(self):
+        # "\n\n" is a single token, so two one token chunks fill 3
+        chunks = group_chunks(["a", "b", "c"], [1, 1, 1], max_len=3)
+        assert chunks == ["a\n\nb", "c"]
+        assert group_chunks(["a", "b"], [1, 1], max_len=4, overhead=2) == ["a", "b"]
+        assert group_chunks([], []) == []
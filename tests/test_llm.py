@@ -0,0 +1,37 @@
+import unittest
+from types import SimpleNamespace
+
+try:
+    from ai_request import llm
+except ImportError:
+    llm = None
+
+
+@unittest.skipIf(llm is None, "openai, redis or tiktoken are not installed")
+class TestLlmMethods(unittest.TestCase):
+    def test_parse_reset(self):
+        assert llm.parse_reset('2') == 2
+        assert llm.parse_reset('0.5') == 0.5
+        assert llm.parse_reset('20ms') == 0.02
+        assert llm.parse_reset('6m0s') == 360
+        assert llm.parse_reset('1h2m3.5s') == 3723.5
+        assert llm.parse_reset('soon') is None
+
+    def test_retry_after_prefers_retry_headers(self):
+        error = SimpleNamespace(headers={'retry-after-ms': '1500', 'retry-after': '9'})
+        assert llm.retry_after(error) == 1.5
+        error = SimpleNamespace(headers={
+            'retry-after': '2', 'x-ratelimit-remaining-tokens': '0', 'x-ratelimit-reset-tokens': '6m0s'})
+        assert llm.retry_after(error) == 2
+
+    def test_retry_after_exhausted_budget(self):
+        error = SimpleNamespace(headers={
+            'x-ratelimit-remaining-requests': '12', 'x-ratelimit-reset-requests': '6m0s',
+            'x-ratelimit-remaining-tokens': '0', 'x-ratelimit-reset-tokens': '1.5s'})
+        assert llm.retry_after(error) == 1.5
+
+    def test_retry_after_unknown(self):
+        assert llm.retry_after(Exception()) is None
+        error = SimpleNamespace(headers={
+            'x-ratelimit-remaining-tokens': '300', 'x-ratelimit-reset-tokens': '6m0s'})
+        assert llm.retry_after(error) is None
@@ -0,0 +1,31 @@
+import unittest
+from audio.plan import expected_completion, max_slice_duration, min_slice_count, plan_slice_count
+
+
+class TestPlanMethods(unittest.TestCase):
+    def test_max_slice_duration(self):
+        # 32 kbps is 4000 bytes a second
+        duration = max_slice_duration(32000, upload_limit=4000 * 60)
+        assert duration == 54 * 1000
+
+    def test_min_slice_count(self):
+        longest = max_slice_duration(320000)
+        assert min_slice_count(longest, 320000) == 1
+        assert min_slice_count(longest, 320000, slack=1000) == 2
+
+    def test_plan_slice_count(self):
+        minute = 60 * 1000
+        # A 25 minute episode is split evenly across the free concurrency
+        assert plan_slice_count(25 * minute, 32000, concurrency=5) == 5
+        assert plan_slice_count(25 * minute, 32000, concurrency=1) == 1
+        # Never below the minimum slice length
+        assert plan_slice_count(minute, 32000, concurrency=6) == 1
+        assert plan_slice_count(5 * minute, 32000, concurrency=6) == 2
+        # 320 kbps can not fit an hour in a few slices under 25 MB
+        hour = 60 * minute
+        assert plan_slice_count(hour, 320000, concurrency=1) == min_slice_count(hour, 320000)
+
+    def test_expected_completion(self):
+        hour = 60 * 60 * 1000
+        assert expected_completion(hour, 8, 8) < expected_completion(hour, 4, 8)
+        assert expected_completion(hour, 8, 8) < expected_completion(hour, 9, 8)
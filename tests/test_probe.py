@@ -0,0 +1,20 @@
+import unittest
+from audio.probe import is_remote, parse_progress_duration
+
+
+class TestProbeMethods(unittest.TestCase):
+    def test_parse_progress_duration(self):
+        progress = """out_time_us=1000000
+out_time=00:00:01.000000
+progress=continue
+out_time_us=61040000
+out_time=00:01:01.040000
+progress=end
+"""
+        assert parse_progress_duration(progress) == 61040
+        assert parse_progress_duration("out_time_us=N/A\nprogress=end\n") is None
+        assert parse_progress_duration("") is None
+
+    def test_is_remote(self):
+        assert is_remote("https://example.com/episode.mp3")
+        assert not is_remote("/external/recording.webm")
@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+try:
+    from ai_request import transcribe
+except ImportError:
+    transcribe = None
+
+
+@unittest.skipIf(transcribe is None, "openai, redis or requests are not installed")
+class TestTranscribeMethods(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.mp3')
+        os.close(fd)
+        self.audio = transcribe.AudioSlice(self.path, 0, 2000)
+        self.reply = {
+            'segments': [{'start': 0.0, 'end': 1.0, 'text': ' Hello there.'}],
+            'words': [{'start': 0.0, 'end': 0.4, 'word': 'Hello'}, {'start': 0.5, 'end': 1.0, 'word': 'there.'}],
+        }
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def transcribe(self, word_timestamps):
+        reply = transcribe.openai.openai_object.OpenAIObject.construct_from(self.reply)
+        with mock.patch.object(transcribe.openai.Audio, 'transcribe', return_value=reply) as stub, \
+                mock.patch.object(transcribe, 'TRANSCRIBE_WORD_TIMESTAMPS', word_timestamps), \
+                mock.patch.object(transcribe.request_bucket, 'acquire'), \
+                mock.patch.object(transcribe.audio_bucket, 'acquire'):
+            cues = transcribe.openai_transcribe(self.audio, 'prompt')
+        return stub.call_args.kwargs, cues
+
+    def test_word_timestamps_request(self):
+        params, cues = self.transcribe(True)
+        assert params['response_format'] == 'verbose_json'
+        assert params['timestamp_granularities[]'] == ['segment', 'word']
+        assert 'timestamp_granularities' not in params
+        assert cues[0].words == [(0, 400, 'Hello'), (500, 1000, 'there.')]
+
+    def test_segments_request(self):
+        params, cues = self.transcribe(False)
+        assert 'timestamp_granularities[]' not in params
+        assert cues[0].text == 'Hello there.'
+        assert cues[0].words is None
+
+    def local_model(self):
+        segments = [
+            SimpleNamespace(start=0.0, end=1.0, text=' Hello there.', words=[
+                SimpleNamespace(start=0.0, end=0.4, word=' Hello'), SimpleNamespace(start=0.5, end=1.0, word=' there.')]),
+            SimpleNamespace(start=1.0, end=2.0, text=' General Kenobi.', words=None),
+        ]
+        model = mock.Mock()
+        model.transcribe.side_effect = lambda *args, **kwargs: (iter(segments), None)
+        return model
+
+    def test_local_transcribe(self):
+        model = self.local_model()
+        cues = transcribe.local_transcribe(self.audio, '', model=model)
+        assert model.transcribe.call_args.args == (self.path,)
+        assert model.transcribe.call_args.kwargs['initial_prompt'] is None
+        assert [(cue.id, cue.start, cue.end, cue.text) for cue in cues] == [
+            (1, 0, 1000, 'Hello there.'), (2, 1000, 2000, 'General Kenobi.')]
+        assert cues[0].words == [(0, 400, 'Hello'), (500, 1000, 'there.')]
+        assert cues[1].words is None
+
+    def test_local_model_loaded_once(self):
+        whisper_model = mock.Mock(side_effect=lambda *args, **kwargs: self.local_model())
+        faster_whisper = SimpleNamespace(WhisperModel=whisper_model)
+        with mock.patch.dict('sys.modules', {'faster_whisper': faster_whisper}), \
+                mock.patch.object(transcribe, 'local_model', None):
+            first = transcribe.local_transcribe(self.audio, 'prompt')
+            second = transcribe.local_transcribe(self.audio, 'prompt')
+        assert whisper_model.call_count == 1
+        assert [cue.text for cue in first] == [cue.text for cue in second]
@@ -0,0 +1,56 @@
+import json
+import unittest
+from unittest import mock
+
+try:
+    from ai_request import translate
+except ImportError:
+    translate = None
+
+
+def reply(translations):
+    return json.dumps(translations, ensure_ascii=False)
+
+
+@unittest.skipIf(translate is None, "openai, redis or tiktoken are not installed")
+class TestTranslateMethods(unittest.TestCase):
+    def setUp(self):
+        patches = [
+            mock.patch.object(translate, 'get_cached_translations',
+                              side_effect=lambda texts, locale: [None] * len(texts)),
+            mock.patch.object(translate, 'save_translations'),
+            mock.patch.object(translate, 'count_tokens',
+                              side_effect=lambda texts, model: [1] * len(texts)),
+            mock.patch.object(translate, 'prompt_overhead', return_value=0),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_parse_translations(self):
+        ids = {'0': 'Hello', '1': 'Bye', '2': 'Yes', '3': 'No'}
+        fenced = '```json\n' + reply({'0': 'Hallo', '1': 'Tschüss'}) + '\n```'
+        assert translate.parse_translations(fenced, ids) == {'0': 'Hallo', '1': 'Tschüss'}
+        mixed = reply({'0': ' Hallo ', '1': '', '2': 3, '3': None, '9': 'Unbekannt'})
+        assert translate.parse_translations(mixed, ids) == {'0': 'Hallo'}
+        assert translate.parse_translations('not json', ids) == {}
+        assert translate.parse_translations('["Hallo"]', ids) == {}
+
+    def test_translate_batch_rerequests_missing_ids(self):
+        replies = [reply({'0': 'Hallo', '2': 'Ja'}), reply({'1': 'Tschüss'})]
+        with mock.patch.object(translate, 'chat_completion', side_effect=replies) as stub:
+            translations = translate.translate_batch(
+                {'0': 'Hello', '1': 'Bye', '2': 'Yes'}, 'de')
+        assert translations == {'0': 'Hallo', '1': 'Tschüss', '2': 'Ja'}
+        assert stub.call_count == 2
+        second_request = json.loads(stub.call_args_list[1].args[0][1]['content'])
+        assert second_request == {'1': 'Bye'}
+
+    def test_translate_gpt_leaves_missing_untranslated(self):
+        subtitles = [{'text': 'Hello'}, {'text': 'Bye'}, {'text': 'Yes'}]
+        with mock.patch.object(translate, 'chat_completion', return_value=reply({'0': 'Hallo', '2': 'Ja'})) as stub:
+            translate.translate_gpt(subtitles, 'de')
+        assert stub.call_count == translate.TRANSLATE_ATTEMPTS
+        assert subtitles[0]['default_translation_text'] == 'Hallo'
+        assert 'default_translation_text' not in subtitles[1]
+        assert subtitles[2]['default_translation_text'] == 'Ja'
@@ -1,5 +1,6 @@
 import unittest
-from utils import merge_multiple_srt_strings
+from types import SimpleNamespace
+from utils import Cue, join_cues, merge_cues, pack_batches, merge_multiple_srt_strings, parse_srt, parse_subtitles, render_cues, segments_to_cues
 
 class TestUtilsMethods(unittest.TestCase):
     def test_merge_multiple_srt(self):
@@ -50,6 +51,109 @@ Fifth subtitle
 6
 01:00:04,000 --> 01:00:06,000
 Sixth subtitle"""
-        merged = merge_multiple_srt_strings(srt1, srt2, srt3)
+        merged = merge_multiple_srt_strings(srt1, srt2, srt3, offsets=[0, 3542000, 3544000])
         print(merged, expected_result, sep="\n")
         assert merged == expected_result
+
+    def test_merge_cues_offsets(self):
+        srt = """1
+00:00:00,000 --> 00:00:01,000
+First subtitle
+
+2
+00:00:02,000 --> 00:00:03,000
+Second subtitle
+"""
+        merged = merge_cues([parse_subtitles(srt), [], parse_subtitles(srt)], [0, 300000, 600000])
+        assert [cue.id for cue in merged] == [1, 2, 3, 4]
+        assert [(cue.start, cue.end) for cue in merged] == [
+            (0, 1000), (2000, 3000), (600000, 601000), (602000, 603000)
+        ]
+        many = merge_multiple_srt_strings(*[srt] * 3, offsets=[0, 60000, 120000])
+        assert parse_srt(many)[-1]["time"] == "00:02:02,000 --> 00:02:03,000"
+
+    def test_segments_to_cues(self):
+        segments = [
+            SimpleNamespace(start=0.0, end=2.5, text=" Hello there."),
+            SimpleNamespace(start=2.5, end=61.04, text=" General Kenobi."),
+        ]
+        cues = segments_to_cues(segments)
+        assert render_cues(cues) == """1
+00:00:00,000 --> 00:00:02,500
+Hello there.
+
+2
+00:00:02,500 --> 00:01:01,040
+General Kenobi."""
+        assert render_cues(cues, "text") == "Hello there. General Kenobi."
+
+    def test_segments_to_cues_words(self):
+        segments = [
+            SimpleNamespace(start=0.0, end=1.0, text=" Hello there."),
+            SimpleNamespace(start=1.0, end=2.0, text=" General Kenobi."),
+        ]
+        words = [
+            SimpleNamespace(start=0.0, end=0.4, word="Hello"),
+            SimpleNamespace(start=0.5, end=1.0, word=" there."),
+            SimpleNamespace(start=1.1, end=1.5, word=" General"),
+            SimpleNamespace(start=1.5, end=2.1, word=" Kenobi."),
+        ]
+        cues = segments_to_cues(segments, words)
+        assert cues[0].words == [(0, 400, "Hello"), (500, 1000, "there.")]
+        assert cues[1].words == [(1100, 1500, "General"), (1500, 2100, "Kenobi.")]
+        joined = join_cues(cues, 0, 2500)
+        assert joined[0].text == "Hello there. General Kenobi."
+        assert len(joined[0].words) == 4
+        item = merge_cues([cues], [1000])[1].to_srt_item()
+        assert item["words"][0] == [2100, 2500, "General"]
+        assert Cue.from_srt_item(item).words[1] == (2500, 3100, "Kenobi.")
+
+    def test_parse_vtt(self):
+        vtt = """WEBVTT
+
+NOTE whisper output
+
+intro
+00:01.500 --> 00:03.000 align:start
+Hello
+there
+
+01:00:03.000 --> 01:00:04.250
+General Kenobi.
+"""
+        cues = parse_subtitles(vtt)
+        assert [(cue.id, cue.start, cue.end, cue.text) for cue in cues] == [
+            (1, 1500, 3000, "Hello\nthere"),
+            (2, 3603000, 3604250, "General Kenobi."),
+        ]
+        assert render_cues(cues, "vtt").startswith("WEBVTT\n\n1\n00:00:01.500 --> 00:00:03.000\n")
+        assert Cue.from_srt_item(parse_srt(render_cues(cues))[1]).end == 3604250
+        assert parse_srt("\n") == []
+
+    def test_pack_batches_separator(self):
+        # 3 + 1 + 3 fits 7 exactly, a third item does not
+        assert pack_batches([3, 3, 3], max_len=7, separator_tokens=1) == [[0, 1], [2]]
+        assert pack_batches([3, 3, 3], max_len=6, separator_tokens=1) == [[0], [1], [2]]
+        assert pack_batches([3, 3, 3], max_len=6) == [[0, 1], [2]]
+
+    def test_pack_batches_overhead(self):
+        assert pack_batches([3, 3], max_len=10, overhead=3, separator_tokens=1) == [[0, 1]]
+        assert pack_batches([3, 3], max_len=10, overhead=4, separator_tokens=1) == [[0], [1]]
+
+    def test_pack_batches_oversize(self):
+        assert pack_batches([10, 2, 2], max_len=5, separator_tokens=1) == [[0], [1, 2]]
+        assert pack_batches([2, 10, 2], max_len=5, separator_tokens=1) == [[0], [1], [2]]
+
+    def test_pack_batches_fills_budget(self):
+        ntokens = [(i * 7) % 13 + 1 for i in range(500)]
+        budget = 100 - 20
+        batches = pack_batches(ntokens, max_len=100, overhead=20, separator_tokens=1)
+        assert [index for batch in batches for index in batch] == list(range(500))
+        for batch, following in zip(batches, batches[1:]):
+            used = sum(ntokens[index] for index in batch) + len(batch) - 1
+            assert used <= budget
+            # The next item would not have fit
+            assert used + 1 + ntokens[following[0]] > budget
+
+    def test_pack_batches_empty(self):
+        assert pack_batches([]) == []
@@ -0,0 +1,111 @@
+"""
+State of resumable uploads, tus style: the audio is appended chunk by chunk
+to its final file on the volume, with a small json sidecar holding the
+expected length and the transcription options until the last chunk lands.
+"""
+import fcntl
+import json
+import os
+import time
+import uuid
+import aiofiles
+import aiofiles.os
+
+VOLUME_PATH = os.environ.get('RAILWAY_VOLUME_MOUNT_PATH', '/external')
+# Uploads with no new chunk for this many seconds are removed
+UPLOAD_EXPIRY = int(os.environ.get('UPLOAD_EXPIRY', 24 * 60 * 60))
+
+
+class UploadOffsetError(Exception):
+    pass
+
+
+def state_path(upload_id: str) -> str:
+    return os.path.join(VOLUME_PATH, upload_id + '.upload.json')
+
+
+async def create_upload(user_id: str, name: str, length: int, prompt: str, srt: bool) -> dict:
+    upload_id = str(uuid.uuid4())
+    file_name, file_extension = os.path.splitext(name)
+    upload = {
+        'id': upload_id,
+        'user_id': user_id,
+        'filename': upload_id + file_extension,
+        'name': file_name,
+        'length': length,
+        'prompt': prompt,
+        'srt': srt,
+    }
+    async with aiofiles.open(os.path.join(VOLUME_PATH, upload['filename']), 'wb'):
+        pass
+    async with aiofiles.open(state_path(upload_id), 'w') as f:
+        await f.write(json.dumps(upload))
+    return upload
+
+
+async def get_upload(upload_id: str) -> dict | None:
+    try:
+        async with aiofiles.open(state_path(upload_id)) as f:
+            return json.loads(await f.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+async def get_upload_offset(upload: dict) -> int:
+    return await aiofiles.os.path.getsize(os.path.join(VOLUME_PATH, upload['filename']))
+
+
+async def append_upload(upload: dict, offset: int, chunks) -> int:
+    """
+    Append the body chunks at offset, which must be where the file ends.
+    The sidecar is locked from the offset check to the last write, so a
+    second request for the same upload is refused instead of appending the
+    same bytes twice. Returns the new offset.
+    """
+    with open(state_path(upload['id'])) as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadOffsetError('Upload is already being appended to')
+        try:
+            current = await get_upload_offset(upload)
+            if offset != current:
+                raise UploadOffsetError(f'Upload is at offset {current}')
+            async with aiofiles.open(os.path.join(VOLUME_PATH, upload['filename']), 'ab') as f:
+                async for chunk in chunks:
+                    if current + len(chunk) > upload['length']:
+                        raise UploadOffsetError('Upload is longer than announced')
+                    await f.write(chunk)
+                    current += len(chunk)
+            return current
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+async def finish_upload(upload: dict):
+    await aiofiles.os.remove(state_path(upload['id']))
+
+
+def expire_uploads(max_age: int = UPLOAD_EXPIRY):
+    """
+    Remove the sidecar and partial file of every upload that has not
+    received a chunk for max_age seconds.
+    """
+    now = time.time()
+    for name in os.listdir(VOLUME_PATH):
+        if not name.endswith('.upload.json'):
+            continue
+        path = os.path.join(VOLUME_PATH, name)
+        try:
+            with open(path) as f:
+                upload = json.load(f)
+            filename = os.path.join(VOLUME_PATH, upload['filename'])
+            updated = max(os.path.getmtime(path), os.path.getmtime(filename)
+                          if os.path.exists(filename) else 0)
+            if now - updated < max_age:
+                continue
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.remove(path)
+        except (OSError, ValueError, KeyError):
+            continue
@@ -1,5 +1,5 @@
 import logging
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 
 SrtItem = Dict[str, any]  # type: ignore
 SrtTimestamp = str
@@ -16,76 +16,187 @@ def get_logger(name, level=logging.INFO):
 
 logger = get_logger(__name__)
 
-def parse_srt(srt_string: str) -> List[SrtItem]:
-    srt_lines = srt_string.strip().split("\n\n")
-    srt_items = []
-    for line in srt_lines:
-        parts = line.strip().split("\n")
-        start_time = parts[1].split(" --> ")[0]
-        end_time = parts[1].split(" --> ")[1]
-        srt_item = {
-            "id": int(parts[0]),
-            "time": parts[1],
+Word = Tuple[int, int, str]
+
+
+class Cue:
+    """
+    One subtitle with start and end in milliseconds, and optionally the
+    (start, end, word) timings of its words.
+    """
+    __slots__ = ("id", "start", "end", "text", "words")
+
+    def __init__(self, id: int, start: int, end: int, text: str, words: Optional[List[Word]] = None):
+        self.id = id
+        self.start = start
+        self.end = end
+        self.text = text
+        self.words = words
+
+    def __repr__(self):
+        return f"Cue({self.id}, {self.start}, {self.end}, {self.text!r})"
+
+    def shifted(self, offset: int, id: Optional[int] = None) -> "Cue":
+        words = None
+        if self.words is not None:
+            words = [(start + offset, end + offset, word) for start, end, word in self.words]
+        return Cue(self.id if id is None else id, self.start + offset, self.end + offset, self.text, words)
+
+    def to_srt_item(self) -> SrtItem:
+        start_time = format_timestamp(self.start)
+        end_time = format_timestamp(self.end)
+        item = {
+            "id": self.id,
+            "time": f"{start_time} --> {end_time}",
             "start_time": start_time,
             "end_time": end_time,
-            "text": "\n".join(parts[2:])
+            "text": self.text
         }
-        srt_items.append(srt_item)
-    return srt_items
+        if self.words is not None:
+            item["words"] = [list(word) for word in self.words]
+        return item
+
+    @classmethod
+    def from_srt_item(cls, item: SrtItem) -> "Cue":
+        words = item.get("words")
+        if words is not None:
+            words = [tuple(word) for word in words]
+        return cls(item["id"], parse_timestamp(item["start_time"]),
+                   parse_timestamp(item["end_time"]), item["text"], words)
+
+
+def parse_timestamp(timestamp: str) -> int:
+    """Milliseconds from an SRT (00:00:01,500) or VTT (00:01.500) timestamp."""
+    clock, _, fraction = timestamp.strip().replace(",", ".").partition(".")
+    seconds = 0
+    for part in clock.split(":"):
+        seconds = seconds * 60 + int(part)
+    return seconds * 1000 + int(fraction[:3].ljust(3, "0") or 0)
+
+
+def format_timestamp(milliseconds: int, separator: str = ",") -> str:
+    hours, milliseconds = divmod(int(milliseconds), 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{milliseconds:03d}"
+
+
+def parse_subtitles(subtitles: str) -> List[Cue]:
+    """
+    Cues of an SRT or WebVTT document, read line by line in a single pass.
+    VTT headers, notes and cue settings are skipped, cues without a numeric
+    id are numbered by position.
+    """
+    cues = []
+    cue_id = None
+    cue = None
+    lines: List[str] = []
+    for line in subtitles.splitlines():
+        line = line.strip()
+        if cue is not None:
+            if line:
+                lines.append(line)
+                continue
+            cue.text = "\n".join(lines)
+            cues.append(cue)
+            cue = None
+            cue_id = None
+        elif "-->" in line:
+            start, _, end = line.partition("-->")
+            cue = Cue(cue_id if cue_id is not None else len(cues) + 1,
+                      parse_timestamp(start), parse_timestamp(end.split()[0]), "")
+            lines = []
+        else:
+            cue_id = int(line) if line.isdigit() else None
+    if cue is not None:
+        cue.text = "\n".join(lines)
+        cues.append(cue)
+    return cues
+
+
+def render_cues(cues: List[Cue], format: str = "srt") -> str:
+    if format == "text":
+        return " ".join([cue.text for cue in cues])
+    if format == "vtt":
+        return "WEBVTT\n\n" + "\n\n".join([
+            f"{cue.id}\n{format_timestamp(cue.start, '.')} --> {format_timestamp(cue.end, '.')}\n{cue.text}"
+            for cue in cues])
+    return "\n\n".join([
+        f"{cue.id}\n{format_timestamp(cue.start)} --> {format_timestamp(cue.end)}\n{cue.text}"
+        for cue in cues])
+
+
+def segments_to_cues(segments, words=None) -> List[Cue]:
+    """
+    Cues from whisper segments with start and end in seconds. Word timings
+    come from each segment's own words (faster-whisper), or are matched to
+    segments by start time from a separate list (the whisper API).
+    """
+    cues = []
+    pending = iter(words or [])
+    word = next(pending, None)
+    for i, segment in enumerate(segments):
+        cue = Cue(i + 1, round(segment.start * 1000),
+                  round(segment.end * 1000), segment.text.strip())
+        segment_words = getattr(segment, "words", None)
+        if segment_words is None and words is not None:
+            segment_words = []
+            is_last = i == len(segments) - 1
+            while word is not None and (is_last or word.start < segment.end):
+                segment_words.append(word)
+                word = next(pending, None)
+        if segment_words is not None:
+            cue.words = [(round(w.start * 1000), round(w.end * 1000), w.word.strip())
+                         for w in segment_words]
+        cues.append(cue)
+    return cues
+
+
+def join_cues(cues: List[Cue], start: int, end: int) -> List[Cue]:
+    """All cues as a single one spanning start to end, for plain text."""
+    if len(cues) == 0:
+        return []
+    words = None
+    if all(cue.words is not None for cue in cues):
+        words = [word for cue in cues for word in cue.words]  # type: ignore
+    return [Cue(1, start, end, " ".join([cue.text for cue in cues]), words)]
+
+
+def shift_cues(cues: List[Cue], offset: int) -> List[Cue]:
+    """Move cues later by offset milliseconds."""
+    return [cue.shifted(offset) for cue in cues]
+
+
+def merge_cues(slices: List[List[Cue]], offsets: List[int]) -> List[Cue]:
+    """
+    Merge the cues of consecutive slices in one pass, moving each slice by
+    its start offset (ms) and numbering the result from 1.
+    """
+    merged = []
+    for cues, offset in zip(slices, offsets):
+        for cue in cues:
+            merged.append(cue.shifted(offset, len(merged) + 1))
+    return merged
+
+
+def parse_srt(srt_string: str) -> List[SrtItem]:
+    return [cue.to_srt_item() for cue in parse_subtitles(srt_string)]
 
 
 def convert_time_to_milliseconds(time_str: SrtTimestamp) -> int:
-    hours, minutes, seconds = time_str.split(":")
-    s, ms = seconds.split(",")
-    return (
-        int(hours) * 60 * 60 * 1000 +
-        int(minutes) * 60 * 1000 +
-        int(s) * 1000 +
-        int(ms)
-    )
+    return parse_timestamp(time_str)
+
+
 def convert_milliseconds_to_time(milliseconds: int) -> str:
-    ms = int(milliseconds % 1000)
-    seconds = int((milliseconds // 1000) % 60)
-    minutes = int((milliseconds // (1000 * 60)) % 60)
-    hours = int((milliseconds // (1000 * 60 * 60)))
-    return f"{hours:02d}:{minutes:02d}:{seconds:02d},{ms:03d}"
+    return format_timestamp(milliseconds)
 
 
 def get_duration(start_time: SrtTimestamp, end_time: SrtTimestamp) -> int:
-    start_milliseconds = convert_time_to_milliseconds(start_time)
-    end_milliseconds = convert_time_to_milliseconds(end_time)
-    return end_milliseconds - start_milliseconds
-
-
-def merge_srt_strings(srt1: str, srt2: str) -> str:
-    srt1_parsed = parse_srt(srt1)
-    srt2_parsed = parse_srt(srt2)
-
-    last_time_srt1 = srt1_parsed[-1]
-    _, end = last_time_srt1["time"].split(" --> ")
-    end_time_srt1 = convert_time_to_milliseconds(end)
-
-    srt2_adjusted = []
-    for subtitle in srt2_parsed:
-        start, end = subtitle["time"].split(" --> ")
-        time_in_ms = convert_time_to_milliseconds(start)
-        
-        end_time_srt1 = time_in_ms + end_time_srt1
-        start_adjusted = convert_milliseconds_to_time(end_time_srt1)
-        duration = get_duration(start, end)
-        adjusted_time = duration + end_time_srt1
-        end_adjusted = convert_milliseconds_to_time(adjusted_time)
-        srt2_adjusted.append({
-            "id": subtitle["id"] + len(srt1_parsed),
-            "time": f"{start_adjusted} --> {end_adjusted}",
-            "text": subtitle["text"]
-        })
-
-    merged_subtitles = srt1_parsed + srt2_adjusted
-    for i, subtitle in enumerate(merged_subtitles):
-        subtitle["id"] = i + 1
-
-    return "\n\n".join([f"{subtitle['id']}\n{subtitle['time']}\n{subtitle['text']}" for subtitle in merged_subtitles])
+    return parse_timestamp(end_time) - parse_timestamp(start_time)
+
+
+def merge_srt_strings(srt1: str, srt2: str, offset: int) -> str:
+    return merge_multiple_srt_strings(srt1, srt2, offsets=[0, offset])
 
 
 def merge_multi_srt_items(*items: SrtItem) -> SrtItem:
@@ -106,9 +217,33 @@ def int_to_subtitle_time(seconds: float):
     return f"{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}"
 
 
-def merge_multiple_srt_strings(*srts: str) -> str:
-    first_srt, *remaining_srts = srts
-    merged_srt_string = first_srt
-    for srt in remaining_srts:
-        merged_srt_string = merge_srt_strings(merged_srt_string, srt)
-    return merged_srt_string
+def merge_multiple_srt_strings(*srts: str, offsets: List[int]) -> str:
+    """
+    Each srt is shifted by its slice's start offset in ms, as in merge_cues.
+    """
+    slices = [parse_subtitles(srt) for srt in srts]
+    return render_cues(merge_cues(slices, offsets))
+
+
+def pack_batches(ntokens, max_len=5000, overhead=0, separator_tokens=0) -> List[List[int]]:
+    """
+    Indexes of consecutive items grouped so each batch, counting overhead
+    prompt tokens and separator_tokens between items, stays within max_len
+    tokens. An item longer than that on its own gets a batch to itself.
+    """
+    budget = max_len - overhead
+    batches = []
+    current = []
+    used = 0
+    for index, ntoken in enumerate(ntokens):
+        cost = ntoken + separator_tokens if len(current) > 0 else ntoken
+        if len(current) > 0 and used + cost > budget:
+            batches.append(current)
+            current = []
+            used = 0
+            cost = ntoken
+        current.append(index)
+        used += cost
+    if len(current) > 0:
+        batches.append(current)
+    return batches
@@ -1,28 +1,30 @@
-from datetime import datetime
-import io
-import multiprocessing
+import hashlib
 import traceback
-import openai
 import os
-import uuid
+import shutil
+import time
 from pytube import YouTube
-from pydub import AudioSegment
 
-from celery import Celery
+from celery import Celery, chord
 from dotenv import load_dotenv
-from tqdm import tqdm
-import requests
 from celery.signals import task_postrun
 from celery.exceptions import Ignore
+from kombu import Queue
 from ai_request.fix_subtitle import fix_subtitle
+from audio.download import DownloadError, download_audio, file_fingerprint, remote_fingerprint
+from audio.boundary import SILENCE_TOLERANCE, find_silence_boundaries
+from audio.probe import probe_audio, probe_duration
+from audio.plan import plan_slice_count
+from audio.segment import AudioSlice, segment_audio, slice_bit_rate
 
 from database.database import get_user_credit, update_credit_record, update_credit_record_status
-from database.mongodb import get_subtitles_from_mongodb, save_subtitle_recos_to_mongodb, save_subtitle_result_to_mongodb, save_subtitle_summary_to_mongodb, update_subtitle_result_to_mongodb
+from database.mongodb import TRANSCRIPT_JOB_TTL, clone_subtitles_in_mongodb, delete_transcript_job_from_mongodb, get_cached_transcript, get_subtitles_from_mongodb, get_transcript_job_from_mongodb, move_transcript_job_in_mongodb, renumber_subtitles_in_mongodb, save_cached_transcript, save_subtitle_recos_to_mongodb, save_subtitle_result_to_mongodb, save_subtitle_summary_to_mongodb, save_transcript_job_to_mongodb, update_subtitle_result_to_mongodb, update_transcript_slice_to_mongodb
+from ai_request.rate_limit import redis_client
 from ai_request.recos import subtitle_recos
 from ai_request.summary import subtitle_summary
+from ai_request.transcribe import TRANSCRIBE_TIME_LIMIT, free_concurrency, transcribe_audio
 from ai_request.translate import translate_gpt
-from utils import merge_multiple_srt_strings, parse_srt, logger
-from faster_whisper import WhisperModel
+from utils import shift_cues, logger
 
 load_dotenv()
 celery = Celery('recos', broker=os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379"),
@@ -31,61 +33,157 @@ celery.conf.task_serializer = 'pickle'
 celery.conf.result_serializer = 'pickle'
 celery.conf.accept_content = ['application/json',
                               'pickle', 'application/x-python-serialize']
+# Short transcriptions, long transcriptions and LLM post-processing each get
+# their own queue, so a clip is not stuck behind hours of audio
+INTERACTIVE_QUEUE = 'interactive'
+BULK_QUEUE = 'bulk'
+LLM_QUEUE = 'llm'
+TRANSCRIPT_QUEUES = [INTERACTIVE_QUEUE, BULK_QUEUE, LLM_QUEUE]
+INTERACTIVE_MAX_DURATION = int(
+    os.environ.get('INTERACTIVE_MAX_DURATION', 20 * 60 * 1000))
+# Kombu's redis transport keeps one list per queue and priority step
+QUEUE_PRIORITY_STEPS = [0, 3, 6, 9]
+QUEUE_PRIORITY_SEPARATOR = '\x06\x16'
+celery.conf.task_default_queue = BULK_QUEUE
+# Declared so a worker started without -Q consumes all of them
+celery.conf.task_queues = [Queue(queue) for queue in TRANSCRIPT_QUEUES]
+celery.conf.task_routes = {'subtitles.*': {'queue': LLM_QUEUE}}
+# Long tasks should not sit prefetched on a busy worker
+celery.conf.worker_prefetch_multiplier = 1
 
 ONE_MINUTE = 1000*60
-OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "_")
+VOLUME_PATH = os.environ.get('RAILWAY_VOLUME_MOUNT_PATH', '/external')
+SLICES_PATH = os.path.join(VOLUME_PATH, 'slices')
 ALLOWED_EXTENSIONS = {'mp3', 'mp4', 'mpeg', 'mpga', 'm4a', 'wav', 'webm'}
 
 
+def transcript_queue(duration):
+    """
+    Queue for transcribing duration ms of audio, audio of unknown length is
+    treated as long.
+    """
+    if duration is not None and duration <= INTERACTIVE_MAX_DURATION:
+        return INTERACTIVE_QUEUE
+    return BULK_QUEUE
+
+
+def queue_depths():
+    """
+    Number of tasks waiting in each queue, read from the broker's redis
+    lists. Empty queues have no list at all and count as 0.
+    """
+    pipeline = redis_client.pipeline(transaction=False)
+    for queue in TRANSCRIPT_QUEUES:
+        for priority in QUEUE_PRIORITY_STEPS:
+            pipeline.llen(
+                f'{queue}{QUEUE_PRIORITY_SEPARATOR}{priority}' if priority else queue)
+    lengths = pipeline.execute()
+    steps = len(QUEUE_PRIORITY_STEPS)
+    return {
+        queue: sum(lengths[index * steps:(index + 1) * steps])
+        for index, queue in enumerate(TRANSCRIPT_QUEUES)
+    }
+
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def slice_audio(audio, slice_duration):
-    start_time = datetime.now()
-    slices = []
-    duration = len(audio)
-    start = 0
-    end = slice_duration
-
-    while start <= duration:
-        slices.append(audio[start:end])
-        start += slice_duration
-        end += slice_duration
-
-    end_time = datetime.now()
-    logger.info(f'slicing took {end_time - start_time}')
-    return slices
-
-
-def export_mp3(audio):
-    start_time = datetime.now()
-    filename = '/tmp/' + str(uuid.uuid4()) + '.mp3'
-    audio.export(filename, format="mp3")
-    end_time = datetime.now()
-    logger.info(f'audio saved {filename},  {end_time - start_time}')
-    return filename
-
-
-def transcribe_audio(filename, format, prompt):
-    logger.info(filename)
-    with open(filename, "rb") as f:
-        transcript = openai.Audio.transcribe(
-            "whisper-1", f, api_key=OPENAI_API_KEY, response_format=format, prompt=prompt)
-        # model_size = "medium"
-        # model = WhisperModel(model_size, device='cpu',
-        #                      compute_type="int8", download_root='/data')
-        # segments, info = model.transcribe(f.name, beam_size=5)  # type: ignore
-        # segments = list(segments)
-        os.remove(filename)
-        # result = []
-        # for segment in segments:
-        #     srt = f"{segment.id}" + '\n' + int_to_subtitle_time(segment.start) + \
-        #         ' --> ' + int_to_subtitle_time(segment.end) + \
-        #         '\n' + segment.text + '\n'
-        #     result.append(srt)
-        return transcript
+def transcript_cache_key(fingerprint, format, prompt):
+    return hashlib.sha256(f'{fingerprint}\n{format}\n{prompt}'.encode()).hexdigest()
+
+
+def reuse_cached_transcript(task, cached, user, audio_type):
+    """
+    Copy the subtitles of an earlier task for the same audio, format and
+    prompt instead of transcribing again. The user is charged as usual.
+    """
+    logger.info(f'transcript cache hit, task {cached["task_id"]}')
+    clone_subtitles_in_mongodb(cached['task_id'], task.request.id)
+    update_credit_record(task.request.id, user['sub'],
+                         -round(cached['duration'] / ONE_MINUTE), cached['duration'], audio_type)
+
+
+def expire_slice_dirs(max_age: int = TRANSCRIPT_JOB_TTL):
+    """
+    Remove the slices of jobs untouched for max_age seconds, which failed
+    and were never resumed. Their checkpoints expire along with them.
+    """
+    if not os.path.isdir(SLICES_PATH):
+        return
+    now = time.time()
+    for name in os.listdir(SLICES_PATH):
+        path = os.path.join(SLICES_PATH, name)
+        try:
+            if now - os.path.getmtime(path) >= max_age:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            continue
+
+
+def prepare_transcript_job(task, filename, info, job):
+    """
+    Slice the audio onto the volume and checkpoint the job with its slices,
+    so a retry can pick up where this task stops.
+    """
+    expire_slice_dirs()
+    output_path = os.path.join(SLICES_PATH, task.request.id)
+    os.makedirs(output_path, exist_ok=True)
+    # As many slices as can be transcribed at once, under the upload limit
+    slice_count = plan_slice_count(
+        info['duration'], slice_bit_rate(info, transcribe=True), free_concurrency(), SILENCE_TOLERANCE)
+    boundaries = find_silence_boundaries(
+        filename, info['duration'], slice_count)
+    sliced_audios = segment_audio(
+        filename, info, boundaries, transcribe=True, output_path=output_path)
+    job = {**job, 'slices_path': output_path}
+    slices = [
+        {'index': index, 'path': audio.path, 'start': audio.start,
+            'end': audio.end, 'status': 'pending', 'count': 0}
+        for index, audio in enumerate(sliced_audios)
+    ]
+    save_transcript_job_to_mongodb(job, slices, task.request.id)
+    return {**job, 'slices': slices}
+
+
+def run_transcript_job(task, job, user):
+    """
+    Replace the task with a chord of one subtask per pending slice, which any
+    worker can pick up from the shared volume, and a callback that finishes
+    the job once they are all back. The callback takes over the task id, so
+    clients keep following the same task.
+    """
+    task_id = task.request.id
+    pending = [item for item in job['slices'] if item['status'] != 'done']
+    if len(pending) == 0:
+        return finish_transcript_job(task_id, job, user)
+    # Slices and callback stay on the queue the job was routed to
+    delivery_info = task.request.delivery_info or {}
+    options = {}
+    if delivery_info.get('routing_key'):
+        options['queue'] = delivery_info['routing_key']
+    header = [
+        transcript_slice_task.s(task_id, item, job['format'], job['prompt']).set(**options)
+        for item in pending
+    ]
+    callback = transcript_merge_task.s(task_id, user).set(**options)
+    raise task.replace(chord(header, callback))
+
+
+def finish_transcript_job(task_id, job, user):
+    """
+    Number the subtitles across slices, charge the user and cache the
+    transcript, then drop the checkpoint and the slices.
+    """
+    counts = [item['count'] for item in job['slices']]
+    renumber_subtitles_in_mongodb(task_id, counts)
+    update_credit_record(task_id, user['sub'], -round(job['duration'] / ONE_MINUTE),
+                         job['duration'], job['audio_type'])
+    save_cached_transcript(job['cache_keys'], task_id, job['duration'])
+    delete_transcript_job_from_mongodb(task_id)
+    shutil.rmtree(job['slices_path'], ignore_errors=True)
+    return sum(counts)
 
 
 def get_youtube_audio_url(link):
@@ -103,102 +201,142 @@ def transcript_task_add(url: str, user, srt: bool = False, prompt: str = '', aud
     if (audio_type == 'youtube'):
         url = get_youtube_audio_url(url)
         logger.info(f'youtube audio {url}')
+    format = 'srt' if srt else 'text'
+    credit = get_user_credit(user['sub'])
+    cache_keys = []
+    fingerprint = remote_fingerprint(url)
+    if fingerprint is not None:
+        cache_keys.append(transcript_cache_key(fingerprint, format, prompt))
+        cached = get_cached_transcript(cache_keys)
+        if cached is not None:
+            if (round(cached['duration'] / ONE_MINUTE) > credit):
+                return "Insufficient credit"
+            return reuse_cached_transcript(transcript_task_add, cached, user, audio_type)
+    # Reject from the remote headers before downloading anything
+    remote_duration = probe_duration(url)
+    if (remote_duration is not None and round(remote_duration / ONE_MINUTE) > credit):
+        return "Insufficient credit"
     logger.info(f'downloading: {url}')
     try:
-        response = requests.get(url, stream=True)
-    except requests.exceptions.HTTPError as ex:
+        filename = download_audio(url)
+    except DownloadError as ex:
         transcript_task_add.update_state(
             state='FAILURE',
-            meta={'exc_type': 'HTTPError', 'exc_message': traceback.format_exc().split('\n'), 'custom': 'Failed to fetch audio'})
+            meta={'exc_type': type(ex).__name__, 'exc_message': traceback.format_exc().split('\n'), 'custom': 'Failed to fetch audio'})
         update_credit_record_status(transcript_task_add.request.id, 'failed')
         raise Ignore()
 
-    total_size = int(response.headers.get('content-length', 0))
-
-    # Initialize the bytearray
-    content = bytearray()
-
-    for data in tqdm(response.iter_content(chunk_size=1024 * 1024), total=total_size // 1024 / 1024, unit='MB', unit_scale=True):
-        content.extend(data)
-
-    if response.status_code == 200:
-        logger.info('audio downloaded')
-        credit = get_user_credit(user['sub'])
-        audio = AudioSegment.from_file(io.BytesIO(content))
-        duration = round(len(audio) / ONE_MINUTE)
+    try:
+        info = probe_audio(filename)
+        duration = round(info['duration'] / ONE_MINUTE)
         if (duration > credit):
             return "Insufficient credit"
-        format = 'srt' if srt else 'text'
-        # Slice into max 5-minute chunks
-        sliced_audios = slice_audio(audio, 10 * 60 * 1000)
-        # Save files in /tmp
-        files = []
-        for audio in sliced_audios:
-            logger.info(f'audio length:{len(audio)}')
-            files.append(export_mp3(audio))
-        # Transcribe
-        try:
-            inputs = list(map(lambda file: (file, format, prompt), files))
-            with multiprocessing.Pool(processes=len(inputs)) as pool:
-                results = pool.starmap(transcribe_audio, inputs)
-            update_credit_record(transcript_task_add.request.id,
-                                 user['sub'], -duration, len(audio), audio_type)
-            srts = parse_srt(merge_multiple_srt_strings(
-                *results))  # type: ignore
-            logger.info(f"{len(srts)} text transcriptions")
-            # srts = fix_subtitle(srts)
-            # Save subtitles
-            save_subtitle_result_to_mongodb(
-                srts, transcript_task_add.request.id)
-            logger.info('request sent')
-            return
-        except Exception as ex:
-            transcript_task_add.update_state(
-                state='FAILURE',
-                meta={
-                    'custom': f'translate error, { str(ex) }'
-                })
-            raise Ignore()
-    else:
-        update_credit_record_status(transcript_task_add.request.id, 'failed')
-        transcript_task_add.update_state(
-            state='FAILURE', meta={
-                'custom': 'Failed to fetch audio'})
-        raise Ignore()
+        cache_keys.append(transcript_cache_key(
+            file_fingerprint(filename), format, prompt))
+        cached = get_cached_transcript(cache_keys)
+        if cached is not None:
+            return reuse_cached_transcript(transcript_task_add, cached, user, audio_type)
+        job = prepare_transcript_job(transcript_task_add, filename, info, {
+            'format': format, 'prompt': prompt, 'duration': info['duration'],
+            'audio_type': audio_type, 'cache_keys': cache_keys})
+    finally:
+        os.remove(filename)
+    # Transcribe
+    return run_transcript_job(transcript_task_add, job, user)
 
 
 @celery.task(name="transcript-file.add", soft_time_limit=60*60, time_limit=60*60)
-def transcript_file_task_add(file: bytes, user, srt: bool = False, prompt: str = ''):
+def transcript_file_task_add(file: str, user, srt: bool = False, prompt: str = ''):
+    """
+    Transcribe an uploaded file, passed by its name under VOLUME_PATH so
+    the audio itself never goes through the broker.
+    """
+    format = 'srt' if srt else 'text'
+    filename = os.path.join(VOLUME_PATH, file)
+    info = probe_audio(filename)
     credit = get_user_credit(user['sub'])
-    audio = AudioSegment.from_file(io.BytesIO(file))
-    duration = round(len(audio) / ONE_MINUTE)
+    duration = round(info['duration'] / ONE_MINUTE)
     if (duration > credit):
         return 'Insufficient credit'
-    format = 'srt' if srt else 'text'
-    # Slice into max 5-minute chunks
-    sliced_audios = slice_audio(audio, 10 * 60 * 1000)
-    # Export audio files
-    files = []
-    for audio in sliced_audios:
-        logger.info(f'audio length: {len(audio)}')
-        files.append(export_mp3(audio))
+    cache_keys = [transcript_cache_key(
+        file_fingerprint(filename), format, prompt)]
+    cached = get_cached_transcript(cache_keys)
+    if cached is not None:
+        return reuse_cached_transcript(transcript_file_task_add, cached, user, 'audio')
+    job = prepare_transcript_job(transcript_file_task_add, filename, info, {
+        'format': format, 'prompt': prompt, 'duration': info['duration'],
+        'audio_type': 'audio', 'cache_keys': cache_keys})
     # Transcribe
+    return run_transcript_job(transcript_file_task_add, job, user)
+
+
+@celery.task(name="transcript.resume", soft_time_limit=60*60, time_limit=60*60)
+def transcript_task_resume(previous_task_id: str, user):
+    """
+    Retry a transcription from its checkpoints: subtitles of finished
+    slices are kept and only the other slices are transcribed again.
+    """
+    task_id = transcript_task_resume.request.id
+    move_transcript_job_in_mongodb(previous_task_id, task_id)
+    job = get_transcript_job_from_mongodb(task_id)
+    if job is None:
+        return 'Nothing to resume'
+    # Keep the slices from expiring along with the refreshed checkpoint
+    if os.path.isdir(job['slices_path']):
+        os.utime(job['slices_path'])
+    if (round(job['duration'] / ONE_MINUTE) > get_user_credit(user['sub'])):
+        return 'Insufficient credit'
+    return run_transcript_job(transcript_task_resume, job, user)
+
+
+@celery.task(name="transcript.slice", soft_time_limit=TRANSCRIBE_TIME_LIMIT, time_limit=TRANSCRIBE_TIME_LIMIT)
+def transcript_slice_task(task_id: str, item: dict, format: str, prompt: str):
+    """
+    Transcribe one slice of a job from the shared volume, saving its
+    subtitles and checkpoint. A failed slice is only marked failed, so the
+    other slices still finish and a retry picks it up.
+    """
+    audio = AudioSlice(item['path'], item['start'], item['end'])
+    try:
+        cues = transcribe_audio(audio, format, prompt)
+    except Exception as ex:
+        logger.warning(f'slice {item["index"]} failed, {str(ex)}')
+        update_transcript_slice_to_mongodb(
+            task_id, item['index'], {'status': 'failed'})
+        return False
+    srts = [cue.to_srt_item() for cue in shift_cues(cues, audio.start)]
+    for srt in srts:
+        srt['slice'] = item['index']
+        srt['slice_id'] = srt['id']
+    if len(srts) > 0:
+        save_subtitle_result_to_mongodb(srts, task_id)
+    update_transcript_slice_to_mongodb(
+        task_id, item['index'], {'status': 'done', 'count': len(srts)})
+    job = get_transcript_job_from_mongodb(task_id)
+    if job is not None:
+        done = [slice_item['index']
+                for slice_item in job['slices'] if slice_item['status'] == 'done']
+        transcript_slice_task.update_state(task_id=task_id, state='PROGRESS', meta={
+            'done': done, 'total': len(job['slices'])})
+    return True
+
+
+@celery.task(name="transcript.merge")
+def transcript_merge_task(results, task_id: str, user):
+    job = get_transcript_job_from_mongodb(task_id)
+    if job is None:
+        return
+    failed = [item['index']
+              for item in job['slices'] if item['status'] != 'done']
     try:
-        inputs = list(map(lambda file: (file, format, prompt), files))
-        with multiprocessing.Pool(processes=len(inputs)) as pool:
-            results = pool.starmap(transcribe_audio, inputs)
-        # Update user credit
-        update_credit_record(transcript_file_task_add.request.id,
-                             user['sub'], -duration, len(audio), 'audio')
-        srts = parse_srt(merge_multiple_srt_strings(*results))  # type: ignore
-        # srts = fix_subtitle(srts)
-        # Save subtitles
-        save_subtitle_result_to_mongodb(
-            srts, transcript_file_task_add.request.id)
-        logger.info('request sent')
+        if len(failed) > 0:
+            raise Exception(f'slices {failed} failed')
+        count = finish_transcript_job(task_id, job, user)
+        logger.info(f"{count} text transcriptions")
         return
     except Exception as ex:
-        transcript_file_task_add.update_state(
+        transcript_merge_task.update_state(
+            task_id=task_id,
             state='FAILURE',
             meta={
                 'exc_type': type(ex).__name__,